@@ -1,22 +1,30 @@
+import time
+_import_started = time.perf_counter()  # время импорта — в отчет о запуске (health.startup_report)
 import os
+import shutil
 import logging
-import requests
+import tempfile
+import threading
 import hashlib
 import hmac
-from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware  # <--- ВАЖНО: Добавил импорт
-from twilio.rest import Client as TwilioClient
-from services.doc_processor import DocumentProcessor
-from services.storage import publish_file  # <--- Правильный импорт (Storage)
+from services.http_client import download_media, MediaTooLargeError
+from services.job_queue import enqueue_job, queue_depth, start_worker_pool, stop_worker_pool, worker_status, ensure_lease, live_workers
+from services.messaging import send_message, stop_dispatcher
 from dotenv import load_dotenv
 from sqlmodel import Session, select
-from database import init_db, engine, Client, Document
+from database import init_db, engine, Client, Document, Job, ProcessingTrace, refresh_client_summary, get_client_summary
+from services import metrics, health
 from sqladmin import Admin, ModelView
 from sqladmin.authentication import AuthenticationBackend
 from starlette.requests import Request as StarletteRequest
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+health.startup_phase("import", time.perf_counter() - _import_started)
 
 load_dotenv()
 app = FastAPI()
@@ -66,41 +74,120 @@ class ClientAdmin(ModelView, model=Client):
     icon = "fa-solid fa-user"
 
 class DocumentAdmin(ModelView, model=Document):
-    column_list = [Document.id, Document.client_id, Document.doc_type, Document.file_path, Document.created_at]
+    column_list = [Document.id, Document.client_id, Document.doc_type, Document.file_path, Document.page_count, Document.created_at]
     icon = "fa-solid fa-file"
 
+class JobAdmin(ModelView, model=Job):
+    column_list = [Job.id, Job.user_phone, Job.status, Job.attempts, Job.last_error, Job.created_at]
+    icon = "fa-solid fa-list-check"
+
+class TraceAdmin(ModelView, model=ProcessingTrace):
+    column_list = [ProcessingTrace.id, ProcessingTrace.job_id, ProcessingTrace.user_phone, ProcessingTrace.status,
+                   ProcessingTrace.pages, ProcessingTrace.total_seconds, ProcessingTrace.stages, ProcessingTrace.created_at]
+    icon = "fa-solid fa-stopwatch"
+
 admin.add_view(ClientAdmin)
 admin.add_view(DocumentAdmin)
+admin.add_view(JobAdmin)
+admin.add_view(TraceAdmin)
 
 # --- SERVICES ---
-twilio_client = TwilioClient(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
-processor = DocumentProcessor()
+# 1 — воркеры очереди запускаются вместе с вебом (один контейнер); 0 — отдельно: python worker.py.
+# При gunicorn -w N с EMBEDDED_WORKERS=1 каждый веб-воркер заводит свои JOB_WORKERS процессов.
+EMBEDDED_WORKERS = os.getenv("EMBEDDED_WORKERS", "1") == "1"
+JOB_TEMP_DIR = os.path.join("temp_files", "jobs")
+
+# DocumentProcessor (OpenCV, PyMuPDF, OpenAI, Vision, облако) нужен только воркерам очереди:
+# веб-процесс его не импортирует, воркер создает при старте (get_processor как warmup)
+_processor = None
+_processor_lock = threading.Lock()
+
+def get_processor():
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                from services.doc_processor import DocumentProcessor
+                _processor = DocumentProcessor()
+    return _processor
 
 @app.on_event("startup")
 def on_startup():
+    started = time.perf_counter()
     init_db()
+    health.startup_phase("init_db", time.perf_counter() - started)
+    metrics.reset_snapshots()
+    health.reset()
+
+    # Обработка файлов идет в отдельных процессах, вебхук только ставит задачу в очередь
+    if EMBEDDED_WORKERS:
+        started = time.perf_counter()
+        start_worker_pool(process_file_task, on_failure=notify_job_failed, warmup=get_processor)
+        health.startup_phase("workers", time.perf_counter() - started)
+    health.startup_report()
+
+@app.on_event("startup")
+async def start_health_monitor():
+    # Фоновые задачи в event loop: задержка loop, очередь, воркеры всех серверов и доступность API для /healthz и /readyz
+    health.start_monitor(queue_depth, workers=live_workers)
+
+@app.on_event("shutdown")
+def on_shutdown():
+    health.stop_monitor()
+    stop_worker_pool()
+    stop_dispatcher()
 
 def send_whatsapp_message(to_number, body_text):
-    try:
-        from_number = 'whatsapp:+14155238886'
-        to = f"whatsapp:{to_number}" if not to_number.startswith("whatsapp:") else to_number
-        twilio_client.messages.create(from_=from_number, body=body_text, to=to)
-    except Exception as e:
-        logger.error(f"Twilio error: {e}")
+    # Не блокирует: отправка, лимиты Twilio, повторы и разбиение длинных отчетов — в services/messaging
+    send_message(to_number, body_text)
+
+def notify_job_failed(user_phone):
+    send_whatsapp_message(user_phone, "❌ Сбой обработки.")
+
+def save_trace(session, user_phone, status, pages=0):
+    """Трасса текущей задачи (этапы, вызовы API) -> таблица ProcessingTrace. Вне задачи — None."""
+    trace = metrics.current_trace()
+    if not trace: return None
+    record = ProcessingTrace(user_phone=user_phone, status=status, pages=pages, **trace.to_record())
+    session.add(record)
+    session.flush()
+    logger.info(f"⏱️ Job {trace.job_id}: {record.total_seconds:.1f}s, stages {record.stages}")
+    return record
 
 # --- ГЛАВНАЯ ЛОГИКА ОБРАБОТКИ ---
 def process_file_task(user_phone, media_url, media_type):
+    """
+    Выполняется воркером очереди. Исключение = повтор задачи с задержкой,
+    после последней попытки клиенту уходит notify_job_failed.
+    """
+    from services.storage import publish_file
+    # Своя папка на задачу: параллельные воркеры (и контейнеры с общим temp_files) не пересекаются по именам
+    os.makedirs(JOB_TEMP_DIR, exist_ok=True)
+    job_dir = tempfile.mkdtemp(prefix="job_", dir=JOB_TEMP_DIR)
     with Session(engine) as session:
-        ext = ".pdf" if media_type == "application/pdf" else ".jpg"
-        filename = f"temp_{user_phone}_{os.urandom(4).hex()}{ext}"
-        local_path = os.path.join("temp_files", filename)
+        local_path = None
+        trace_status, trace_pages, trace_saved = "error", 0, False
         
         try:
-            response = requests.get(media_url)
-            with open(local_path, 'wb') as f: f.write(response.content)
+            # Потоковое скачивание: расширение определяем по содержимому, а не по догадке
+            try:
+                with metrics.timer("download"):
+                    local_path = download_media(media_url, job_dir, "media", media_type)
+            except MediaTooLargeError as e:
+                logger.warning(f"Media rejected: {e}")
+                trace_status = "rejected"
+                send_whatsapp_message(user_phone, "⚠️ Файл слишком большой. Пришлите файл поменьше или по частям.")
+                return
+            filename = os.path.basename(local_path)
             
+            # Имя из досье: документы клиента, распознанные правилами, подписываются им без LLM.
+            # Своя короткая сессия: транзакция не должна висеть открытой, пока идут OCR и классификация
+            with Session(engine) as lookup:
+                known_person = lookup.exec(select(Client.full_name).where(Client.phone_number == user_phone)).first()
+            if known_person == "Unknown": known_person = None
+
             # ТЕПЕРЬ ПОЛУЧАЕМ СПИСОК РЕЗУЛЬТАТОВ (Page 1, Page 2...)
-            results_list = processor.process_and_upload(user_phone, local_path, filename)
+            results_list = get_processor().process_and_upload(user_phone, local_path, filename, known_person)
             
             # Если вернулась фатальная ошибка списка
             if not results_list or (len(results_list) == 1 and results_list[0].get("status") == "error"):
@@ -109,15 +196,26 @@ def process_file_task(user_phone, media_url, media_type):
 
             # Перебираем успешные страницы
             success_pages = [r for r in results_list if r["status"] == "success"]
+            trace_pages = len(results_list)
             
             if not success_pages:
                 send_whatsapp_message(user_phone, "⚠️ Не удалось обработать страницы документа.")
                 return
 
+            # Тот же файл уже принимали: документы есть в облаке и в БД, дубли не пишем
+            if all(r.get("cached") for r in success_pages):
+                trace_status = "duplicate"
+                types = ", ".join(sorted({r["doc_type"] for r in success_pages}))
+                send_whatsapp_message(user_phone, f"♻️ Этот файл уже был принят ранее.\n📄 Тип: {types}")
+                return
+
             # Берем имя и тип из первой успешной страницы для клиента
             first_res = success_pages[0]
             person_name = first_res["person"]
             
+            # Запись в БД — только пока задача наша: если аренду перехватил другой воркер, он и запишет
+            ensure_lease(session)
+
             # Обновляем Клиента
             client = session.exec(select(Client).where(Client.phone_number == user_phone)).first()
             if not client:
@@ -129,23 +227,35 @@ def process_file_task(user_phone, media_url, media_type):
             session.commit()
             session.refresh(client)
 
-            # Сохраняем КАЖДУЮ страницу в БД Documents
+            # Один PDF в облаке = одна запись Documents (страницы одного документа собраны в один файл)
             added_types = set()
             last_link = None
-            
+            files = {}
             for page in success_pages:
-                new_doc = Document(client_id=client.id, doc_type=page["doc_type"], file_path=page["filename"])
+                files.setdefault(page["remote_path"], []).append(page)
+
+            # Трасса пишется вместе с документами: по Document.trace_id видно, как он обрабатывался
+            trace = save_trace(session, user_phone, "done", trace_pages)
+            trace_saved = True
+            for remote_path, pages in files.items():
+                new_doc = Document(client_id=client.id, doc_type=pages[0]["doc_type"], file_path=pages[0]["filename"],
+                                   page_count=pages[0].get("page_count", len(pages)), trace_id=trace.id if trace else None)
                 session.add(new_doc)
-                added_types.add(page["doc_type"])
-                last_link = page["remote_path"] # Запомним последнюю ссылку
+                added_types.add(pages[0]["doc_type"])
+                last_link = remote_path # Запомним последнюю ссылку
             
+            # Сводка для «статуса» обновляется в той же транзакции, что и документы
+            ensure_lease(session)
+            summary = refresh_client_summary(session, client)
+            existing = summary.doc_types()
             session.commit()
+            # Только теперь файл считается принятым: повтор задачи до commit обработает его заново
+            get_processor().remember_file(user_phone, local_path, results_list)
             
             # Генерируем ссылку (публикуем последний файл для проверки)
             public_link = publish_file(last_link)
             
             # Считаем остаток
-            existing = {d.doc_type for d in session.exec(select(Document).where(Document.client_id == client.id)).all()}
             missing = REQUIRED_DOCS - existing
             
             # Формируем отчет
@@ -165,35 +275,65 @@ def process_file_task(user_phone, media_url, media_type):
 
         except Exception as e:
             logger.error(f"Task error: {e}")
-            send_whatsapp_message(user_phone, "❌ Сбой обработки.")
+            raise
         finally:
-            if os.path.exists(local_path): os.remove(local_path)
+            shutil.rmtree(job_dir, ignore_errors=True)
+            if not trace_saved:
+                try:
+                    with Session(engine) as trace_session:
+                        save_trace(trace_session, user_phone, trace_status, trace_pages)
+                        trace_session.commit()
+                except Exception as e: logger.error(f"Trace save error: {e}")
+
+# Пробы отвечают из кэша (services/health): без БД, сети и threadpool, поэтому
+# не зависят от нагрузки на воркеры. Async — чтобы не ждать свободного потока.
+@app.get("/healthz")
+async def healthz():
+    """Liveness: процесс жив и event loop отвечает."""
+    return health.liveness()
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: БД отвечает, event loop не тормозит, воркеры живы. Иначе 503."""
+    report = health.readiness(worker_status())
+    return JSONResponse(report, status_code=200 if report["status"] == "ok" else 503)
+
+@app.get("/queue")
+async def queue_status():
+    return await run_in_threadpool(queue_depth)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Метрики всех процессов (веб + воркеры очереди) в формате Prometheus."""
+    depth = await run_in_threadpool(queue_depth)
+    gauges = {"lawbot_queue_jobs": {(("status", status),): count for status, count in depth.items()}}
+    return PlainTextResponse(metrics.render_prometheus(gauges), media_type="text/plain; version=0.0.4")
 
 @app.post("/whatsapp")
-async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
+async def whatsapp_webhook(request: Request):
     form = await request.form()
     user_phone = form.get("From", "").replace("whatsapp:", "")
     media_url = form.get("MediaUrl0")
     
     if media_url:
-        background_tasks.add_task(process_file_task, user_phone, media_url, form.get("MediaContentType0"))
+        await run_in_threadpool(enqueue_job, user_phone, media_url, form.get("MediaContentType0"), form.get("MessageSid"))
         return "OK"
     
     body = form.get("Body", "").strip().lower()
     if body in ["статус", "status", "1", "check"]:
-        with Session(engine) as session:
-            client = session.exec(select(Client).where(Client.phone_number == user_phone)).first()
-            if not client:
-                send_whatsapp_message(user_phone, "📂 Досье пусто.")
-            else:
-                existing = {d.doc_type for d in session.exec(select(Document).where(Document.client_id == client.id)).all()}
-                missing = REQUIRED_DOCS - existing
-                
-                report = f"📂 Досье: {client.full_name}\n✅ Сдано: {len(existing)}\n"
-                if existing: report += f"- " + "\n- ".join(existing) + "\n"
-                if missing: report += f"\n❌ НУЖНО ДОСЛАТЬ ({len(missing)}):\n- " + "\n- ".join(missing)
-                else: report += "\n🎉 Всё готово!"
-                send_whatsapp_message(user_phone, report)
+        # Одна строка сводки по телефону, async-драйвер: event loop не блокируется
+        summary = await get_client_summary(user_phone)
+        if not summary:
+            send_whatsapp_message(user_phone, "📂 Досье пусто.")
+        else:
+            existing = summary.doc_types()
+            missing = REQUIRED_DOCS - existing
+            
+            report = f"📂 Досье: {summary.full_name}\n✅ Сдано: {len(existing)}\n"
+            if existing: report += f"- " + "\n- ".join(existing) + "\n"
+            if missing: report += f"\n❌ НУЖНО ДОСЛАТЬ ({len(missing)}):\n- " + "\n- ".join(missing)
+            else: report += "\n🎉 Всё готово!"
+            send_whatsapp_message(user_phone, report)
         return "OK"
     
     send_whatsapp_message(user_phone, "🤖 Пришлите фото или PDF.")
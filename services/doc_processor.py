@@ -1,233 +1,593 @@
 import os
-import io
 import logging
 import base64
+import tempfile
+import threading
 import img2pdf
-import cv2
-import numpy as np
+import fitz  # PyMuPDF
 from datetime import datetime
-from PIL import Image, ImageOps, ImageEnhance
-from google.cloud import vision
-from pdf2image import convert_from_path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from services.storage import upload_file_to_cloud
-from services.openai_client import analyze_document
+from services import image_pipeline
+from services.ocr_engines import build_ocr_engine, rotate_point, rotated_size
+from services.openai_client import analyze_documents, classify_pages
+from services.rule_classifier import classify_text as rule_classify
+from thefuzz import fuzz
+from services.result_cache import cache_get, cache_put, file_sha256, bytes_sha256
+from services.metrics import timer, inc
 
 logger = logging.getLogger(__name__)
 
 if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "google_credentials.json"
 
+# Сколько страниц одного документа обрабатывать одновременно (1 = последовательно)
+PAGE_CONCURRENCY = int(os.getenv("PAGE_CONCURRENCY", "4"))
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", "200"))
+# Страница с текстовым слоем не меньше этого размера не растеризуется
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "50"))
+# Доля "нормальных" символов: битые шрифты без ToUnicode дают мусор вместо текста
+TEXT_LAYER_MIN_QUALITY = float(os.getenv("TEXT_LAYER_MIN_QUALITY", "0.85"))
+# Если картинки занимают больше этой доли страницы, а текста мало — это скан с подписью, нужен OCR
+TEXT_LAYER_SCAN_IMAGE_RATIO = 0.5
+TEXT_LAYER_SCAN_MAX_CHARS = 300
+# Фото с телефона (12-50 MP) перед OCR и GPT-4o уменьшаем; архивный PDF остается в полном разрешении
+OCR_MAX_DIMENSION = int(os.getenv("OCR_MAX_DIMENSION", "2560"))
+LLM_IMAGE_MAX_DIMENSION = int(os.getenv("LLM_IMAGE_MAX_DIMENSION", "1536"))
+# document: один запрос к LLM на документ, page: на каждую страницу
+CLASSIFY_MODE = os.getenv("CLASSIFY_MODE", "document").lower()
+# Ниже этой похожести текста (0-100) страница считается началом нового документа
+DOC_BOUNDARY_SIMILARITY = int(os.getenv("DOC_BOUNDARY_SIMILARITY", "60"))
+DOC_SIMILARITY_CHARS = 1500
+# document: страницы одного файла одного типа и человека -> один PDF; page: PDF на каждую страницу
+OUTPUT_MODE = os.getenv("OUTPUT_MODE", "document").lower()
+# Буферы страниц и итоговых PDF живут в памяти; больше порога — сбрасываются во временный файл.
+# Для JPEG страниц порог общий на файл: классификация ждет все страницы, и 60-страничный
+# скан не должен держать в памяти все свои JPEG до загрузки
+SPOOL_MAX_MB = int(os.getenv("SPOOL_MAX_MB", "16"))
+
+class PageBuffers:
+    """JPEG страниц одного файла до загрузки: в памяти, пока их сумма не больше SPOOL_MAX_MB, дальше — во временные файлы."""
+    def __init__(self, temp_dir, max_bytes=SPOOL_MAX_MB * 1024 * 1024):
+        self.temp_dir = temp_dir
+        self.max_bytes = max_bytes
+        self.in_memory = 0
+        self.spilled = 0
+        self._lock = threading.Lock()
+
+    def put(self, data):
+        with self._lock:
+            if self.in_memory + len(data) <= self.max_bytes:
+                self.in_memory += len(data)
+                return data
+            self.spilled += 1
+        f = tempfile.TemporaryFile(dir=self.temp_dir)
+        f.write(data)
+        return f
+
+    @staticmethod
+    def read(buf):
+        if isinstance(buf, bytes): return buf
+        buf.seek(0)
+        return buf.read()
+
+    @staticmethod
+    def release(buf):
+        if buf is not None and not isinstance(buf, bytes): buf.close()
+
 class DocumentProcessor:
     def __init__(self):
-        self.temp_dir = "temp_files"
+        self.temp_dir = "temp_files"  # сюда скачиваются входящие файлы и сбрасываются большие буферы
         os.makedirs(self.temp_dir, exist_ok=True)
-        self.vision_client = vision.ImageAnnotatorClient()
+        self.ocr_engine = build_ocr_engine()
 
-    def _fix_exif_orientation_pil(self, img):
-        try: return ImageOps.exif_transpose(img)
-        except: return img
+    def _extract_text_layer(self, page):
+        """
+        Достает встроенный текст страницы, если его достаточно для классификации.
+        Возвращает текст или None (тогда страница идет через растр и OCR).
+        """
+        text = page.get_text("text", sort=True).strip()
+        if len(text) < TEXT_LAYER_MIN_CHARS: return None
 
-    def _convert_pdf_to_jpg(self, pdf_path):
-        try:
-            return convert_from_path(pdf_path, dpi=200)
-        except Exception as e:
-            logger.error(f"PDF->JPG error: {e}")
+        # Мусор вместо букв (битая кодировка шрифта) — лучше отдать в OCR
+        chars = [c for c in text if not c.isspace()]
+        readable = sum(1 for c in chars if c.isalnum() or c in ".,:;-/()№#%+'\"")
+        quality = readable / len(chars) if chars else 0
+        if quality < TEXT_LAYER_MIN_QUALITY:
+            logger.info(f"📄 Text layer rejected: quality {quality:.0%}")
             return None
 
-    def _google_vision_process(self, pil_image, is_retry=False):
+        # Скан с парой строк поверх ("Scanned with CamScanner", штамп) — текст не про документ
+        if len(text) < TEXT_LAYER_SCAN_MAX_CHARS:
+            page_area = abs(page.rect) or 1
+            image_area = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+            if image_area / page_area > TEXT_LAYER_SCAN_IMAGE_RATIO:
+                logger.info(f"📄 Text layer rejected: page is a scan ({image_area / page_area:.0%} images)")
+                return None
+
+        return text
+
+    def _iter_pdf_pages(self, doc):
+        """
+        Генератор страниц PDF: рендерим по одной странице, только когда пайплайн готов ее взять.
+        В памяти одновременно не больше PAGE_CONCURRENCY картинок, а не весь документ.
+        Страница с текстовым слоем не растеризуется: отдаем ее текст и саму страницу как PDF.
+        """
+        try:
+            for index, page in enumerate(doc, start=1):
+                try:
+                    with timer("text_layer"):
+                        text = self._extract_text_layer(page)
+                        if text:
+                            single = fitz.open()
+                            single.insert_pdf(doc, from_page=index - 1, to_page=index - 1)
+                            pdf_bytes = single.tobytes(garbage=3, deflate=True)
+                            single.close()
+                    if text:
+                        logger.info(f"📄 Page {index}: text layer ({len(text)} chars), Vision skipped")
+                        yield {"index": index, "image": None, "text": text, "pdf_bytes": pdf_bytes}
+                        continue
+
+                    with timer("render"):
+                        pix = page.get_pixmap(dpi=PDF_RENDER_DPI)
+                        img = image_pipeline.from_pixmap(pix)
+                        del pix
+                    yield {"index": index, "image": img, "text": "", "pdf_bytes": None}
+                except Exception as e:
+                    logger.error(f"PDF page {index} render error: {e}")
+                    yield {"index": index, "error": f"Render error: {e}"}
+        finally:
+            doc.close()
+
+    def _reading_order(self, blocks):
+        """Сортировка блоков сверху вниз, слева направо (блоки одной строки — по x)."""
+        if not blocks: return blocks
+        heights = sorted(b["box"][3] - b["box"][1] for b in blocks)
+        line_h = max(1, heights[len(heights) // 2] // 2)
+        return sorted(blocks, key=lambda b: (b["box"][1] // line_h, b["box"][0]))
+
+    def _ocr_process(self, page_arr):
         """
         Финальная версия для Демо:
         1. Поворот (Rotation).
         2. Безопасная обрезка (Safe Crop): если документ занимает < 20% кадра, отдаем оригинал.
+        Один запрос к OCR на страницу: при повороте координаты блоков и порядок текста
+        пересчитываются локально, повторный запрос не нужен.
+        Движок OCR (Vision / Tesseract / авто) выбирается через OCR_BACKEND.
+        Сама картинка здесь не меняется: возвращаем (текст, layout), где layout = {"rotation", "crop"},
+        а пиксели обрабатывает image_pipeline.prepare_page за один проход.
         """
         extracted_text = ""
+        layout = {"rotation": 0, "crop": None}
         try:
-            img_byte_arr = io.BytesIO()
-            pil_image.save(img_byte_arr, format='JPEG')
-            content = img_byte_arr.getvalue()
-            image = vision.Image(content=content)
+            size = image_pipeline.image_size(page_arr)
+            small, scale = image_pipeline.downscale(page_arr, OCR_MAX_DIMENSION)
+            content = image_pipeline.encode_jpeg(small)
+            del small
             
-            # --- 1. GOOGLE VISION ---
-            response = self.vision_client.document_text_detection(image=image)
-            
-            if response.error.message:
-                logger.error(f"Google Error: {response.error.message}")
-                return pil_image, ""
-
-            if response.full_text_annotation:
-                extracted_text = response.full_text_annotation.text
-
-            # --- 2. ROTATION ---
-            if not is_retry and response.full_text_annotation.pages:
-                page = response.full_text_annotation.pages[0]
-                if page.blocks:
-                    word = page.blocks[0].paragraphs[0].words[0]
-                    v = word.bounding_box.vertices
-                    dx = v[1].x - v[0].x
-                    dy = v[1].y - v[0].y
-                    import math
-                    rotation_angle = math.degrees(math.atan2(dy, dx))
-                    
-                    final_rotation = 0
-                    if 45 <= rotation_angle < 135: final_rotation = 90
-                    elif -135 < rotation_angle <= -45: final_rotation = -90
-                    elif rotation_angle >= 135 or rotation_angle <= -135: final_rotation = 180
-                    
-                    if final_rotation != 0:
-                        logger.info(f"🔄 Rotation needed: {final_rotation}")
-                        if final_rotation == 90: pil_image = pil_image.rotate(90, expand=True)
-                        elif final_rotation == -90: pil_image = pil_image.rotate(-90, expand=True)
-                        elif final_rotation == 180: pil_image = pil_image.rotate(180, expand=True)
-                        return self._google_vision_process(pil_image, is_retry=True)
+            # --- 1. OCR ---
+            # Распознаем уменьшенную копию, координаты блоков возвращаем в полное разрешение
+            with timer("ocr", engine=self.ocr_engine.name):
+                result = self.ocr_engine.recognize(content, (round(size[0] * scale), round(size[1] * scale)))
+            extracted_text = result["text"]
+            blocks = [
+                {'points': [(x / scale, y / scale) for x, y in b["points"]], 'text': b["text"]}
+                for b in result["blocks"]
+            ]
+
+            # --- 2. ROTATION (локально, по геометрии первого ответа) ---
+            final_rotation = result["rotation"]
+            if final_rotation != 0:
+                logger.info(f"🔄 Rotation needed: {final_rotation}")
+                layout["rotation"] = final_rotation
+                for b in blocks:
+                    b['points'] = [rotate_point(x, y, final_rotation, size) for x, y in b['points']]
+
+            for b in blocks:
+                xs = [x for x, _ in b['points']]
+                ys = [y for _, y in b['points']]
+                b['box'] = (min(xs), min(ys), max(xs), max(ys))
+
+            if final_rotation != 0:
+                # Порядок текста как на повернутой странице
+                ordered = self._reading_order(blocks)
+                extracted_text = "\n".join(b['text'] for b in ordered) or extracted_text
 
             # --- 3. SAFE CROP (Aggressive Union) ---
-            if response.full_text_annotation:
-                blocks = []
-                for page in response.full_text_annotation.pages:
-                    for block in page.blocks:
-                        v = block.bounding_box.vertices
-                        min_x = min(p.x for p in v)
-                        min_y = min(p.y for p in v)
-                        max_x = max(p.x for p in v)
-                        max_y = max(p.y for p in v)
-                        blocks.append({'box': (min_x, min_y, max_x, max_y)})
-
-                if not blocks:
-                    return pil_image, extracted_text
-
-                # Вместо кластеров просто ищем крайние точки ВСЕГО текста на странице
-                w_orig, h_orig = pil_image.size
-                
-                final_min_x = w_orig
-                final_min_y = h_orig
-                final_max_x = 0
-                final_max_y = 0
+            if not blocks:
+                return extracted_text, layout
 
-                for b in blocks:
-                    box = b['box']
-                    final_min_x = min(final_min_x, box[0])
-                    final_min_y = min(final_min_y, box[1])
-                    final_max_x = max(final_max_x, box[2])
-                    final_max_y = max(final_max_y, box[3])
-
-                # Добавляем отступы (Padding)
-                pad = 30
-                final_min_x = max(0, final_min_x - pad)
-                final_min_y = max(0, final_min_y - pad)
-                final_max_x = min(w_orig, final_max_x + pad)
-                final_max_y = min(h_orig, final_max_y + pad)
-
-                area_crop = (final_max_x - final_min_x) * (final_max_y - final_min_y)
-                ratio = area_crop / (w_orig * h_orig)
-
-                # --- ГЛАВНАЯ ЗАЩИТА ДЛЯ ДЕМО ---
-                # Если обрезанная часть составляет менее 15% от всего фото,
-                # значит мы скорее всего вырезали только кусок текста, а не документ.
-                # В таком случае ОТМЕНЯЕМ кроп и отдаем полный кадр.
-                if ratio < 0.15:
-                    logger.warning(f"🛡️ SAFE CROP: Detected small area ({ratio:.1%}). Returning FULL IMAGE to be safe.")
-                    return pil_image, extracted_text
-                
-                logger.info(f"✂️ SAFE CROP: Applied. Ratio {ratio:.1%}")
-                pil_image = pil_image.crop((final_min_x, final_min_y, final_max_x, final_max_y))
-
-            return pil_image, extracted_text
+            # Вместо кластеров просто ищем крайние точки ВСЕГО текста на странице
+            w_orig, h_orig = rotated_size(size, final_rotation)
+            
+            final_min_x = w_orig
+            final_min_y = h_orig
+            final_max_x = 0
+            final_max_y = 0
+
+            for b in blocks:
+                box = b['box']
+                final_min_x = min(final_min_x, box[0])
+                final_min_y = min(final_min_y, box[1])
+                final_max_x = max(final_max_x, box[2])
+                final_max_y = max(final_max_y, box[3])
+
+            # Добавляем отступы (Padding)
+            pad = 30
+            final_min_x = max(0, final_min_x - pad)
+            final_min_y = max(0, final_min_y - pad)
+            final_max_x = min(w_orig, final_max_x + pad)
+            final_max_y = min(h_orig, final_max_y + pad)
+
+            area_crop = (final_max_x - final_min_x) * (final_max_y - final_min_y)
+            ratio = area_crop / (w_orig * h_orig)
+
+            # --- ГЛАВНАЯ ЗАЩИТА ДЛЯ ДЕМО ---
+            # Если обрезанная часть составляет менее 15% от всего фото,
+            # значит мы скорее всего вырезали только кусок текста, а не документ.
+            # В таком случае ОТМЕНЯЕМ кроп и отдаем полный кадр.
+            if ratio < 0.15:
+                logger.warning(f"🛡️ SAFE CROP: Detected small area ({ratio:.1%}). Returning FULL IMAGE to be safe.")
+                return extracted_text, layout
+            
+            logger.info(f"✂️ SAFE CROP: Applied. Ratio {ratio:.1%}")
+            layout["crop"] = tuple(int(round(v)) for v in (final_min_x, final_min_y, final_max_x, final_max_y))
+
+            return extracted_text, layout
 
         except Exception as e:
-            logger.error(f"Google Vision Error: {e}")
-            return pil_image, extracted_text
+            logger.error(f"OCR Error: {e}")
+            return extracted_text, None
 
-    def _enhance_image(self, pil_image):
-        enhancer = ImageEnhance.Contrast(pil_image)
-        pil_image = enhancer.enhance(1.2)
-        return pil_image
+    def _encode_image(self, jpeg_bytes):
+        return base64.b64encode(jpeg_bytes).decode('utf-8')
 
-    def _encode_image(self, path):
-        with open(path, "rb") as f: return base64.b64encode(f.read()).decode('utf-8')
+    def _prepare_page(self, user_phone, page, buffers):
+        """
+        Этап 1 (параллельно по страницам): OCR -> поворот/кроп/контраст -> JPEG в памяти.
+        Ошибки не выбрасывает, а кладет в запись страницы.
+        """
+        i = page["index"]
+        rec = {"index": i, "error": page.get("error"), "pdf_bytes": page.get("pdf_bytes"), "cached": None,
+               "layout": None, "ocr_text": "", "llm_image": None, "doc_data": None, "jpeg": None}
+        if rec["error"]: return rec
 
-    def process_and_upload(self, user_phone, local_path, original_filename):
-        is_pdf = local_path.lower().endswith(".pdf")
-        processed_results = []
-        pil_images = []
-        
-        try:
-            if is_pdf: 
-                pil_images = self._convert_pdf_to_jpg(local_path)
-            else: 
-                pil_images = [self._fix_exif_orientation_pil(Image.open(local_path))]
-        except Exception as e: return [{"status": "error", "message": f"Read error: {e}"}]
+        img = page["image"]  # numpy-массив BGR (см. image_pipeline)
+        page["image"] = None  # картинку держит только этот поток, чтобы память освободилась сразу после страницы
 
-        if not pil_images: return [{"status": "error", "message": "No images"}]
-        source_file_uploaded = False
+        try:
+            # Повторно присланная страница: OCR-текст, поворот/кроп и классификация берутся из кэша
+            if rec["pdf_bytes"]:
+                # Цифровая страница: текст уже есть, поворот/кроп не нужны,
+                # в облако идет исходная векторная страница
+                rec["page_key"] = bytes_sha256("text", page["text"])
+                rec["cached"] = cache_get("page", rec["page_key"])
+                rec["ocr_text"] = page["text"]
+            else:
+                rec["page_key"] = bytes_sha256(str(img.shape), img.data)
+                cached = rec["cached"] = cache_get("page", rec["page_key"])
 
-        for i, img in enumerate(pil_images, start=1):
-            page_suffix = f"_page{i}"
-            temp_page_jpg = os.path.join(self.temp_dir, f"temp_{user_phone}_p{i}.jpg")
-            
-            try:
                 # 1. Processing
-                img, ocr_text = self._google_vision_process(img)
-
-                # 2. Enhance & Save
-                img = self._enhance_image(img)
-                img.save(temp_page_jpg, "JPEG", quality=90)
-                
-                # 3. AI Classification
-                doc_data = {"doc_type": "Document", "person_name": "Unknown"}
-                prompt = ""
-                image_arg = None
-                
-                if ocr_text and len(ocr_text) > 50:
-                    prompt = f"""
-                    Analyze text (Document Page):
-                    '''{ocr_text[:3000]}''' 
-                    1. Type (Passport, ID, Marriage, Birth, etc.)
-                    2. Name (Latin)
-                    JSON: {{"doc_type": "...", "person_name": "..."}}
-                    """
+                if cached:
+                    rec["layout"], rec["ocr_text"] = cached["layout"], cached["ocr_text"]
                 else:
-                    image_arg = self._encode_image(temp_page_jpg)
-                    prompt = """Classify & Extract Name. JSON: {{"doc_type": "...", "person_name": "..."}}"""
+                    rec["ocr_text"], rec["layout"] = self._ocr_process(img)
 
-                try:
-                    res = analyze_document(image_arg, prompt)
-                    if res: doc_data = res
-                except Exception as e: logger.error(f"AI Error: {e}")
-
-                # 4. Save PDF
-                final_pdf_path = os.path.join(self.temp_dir, f"temp_{user_phone}_p{i}.pdf")
-                with open(temp_page_jpg, "rb") as f: pdf_bytes = img2pdf.convert(f.read())
-                with open(final_pdf_path, "wb") as f: f.write(pdf_bytes)
-
-                person = "".join(c for c in doc_data.get('person_name', 'Client') if c.isalnum() or c in ' _-').strip()
-                base_folder = f"/Clients/{user_phone}/{person or 'Client'}"
-                date_s = datetime.now().strftime("%Y-%m-%d")
-                dtype = doc_data.get('doc_type', 'Doc')
-                remote_filename = f"{date_s}_{dtype}{page_suffix}.pdf"
-                remote_path_pdf = f"{base_folder}/{remote_filename}"
-
-                # Original Upload (once per file)
-                if not source_file_uploaded:
-                    orig_ext = os.path.splitext(local_path)[1] or ".jpg"
-                    remote_orig = f"{base_folder}/Originals/{date_s}_{dtype}_Source_orig{orig_ext}"
-                    try:
-                        upload_file_to_cloud(local_path, remote_orig)
-                        source_file_uploaded = True
-                    except: pass
-
-                if upload_file_to_cloud(final_pdf_path, remote_path_pdf):
-                    processed_results.append({
-                        "status": "success", "doc_type": dtype, "person": person, 
-                        "filename": remote_filename, "remote_path": remote_path_pdf
-                    })
-                else:
-                    processed_results.append({"status": "error", "message": "Upload failed"})
+                # 2. Rotate, crop & enhance (один массив) -> один JPEG
+                with timer("preprocess"):
+                    img = image_pipeline.prepare_page(img, rec["layout"])
+                    rec["jpeg"] = buffers.put(image_pipeline.encode_jpeg(img))
+
+                    # Для GPT-4o (если текста мало) — уменьшенная копия, а не полный скан
+                    if not cached and not self._has_text(rec):
+                        rec["llm_image"] = image_pipeline.encode_jpeg(image_pipeline.downscale(img, LLM_IMAGE_MAX_DIMENSION)[0])
+                del img
+
+            if rec["cached"]:
+                rec["doc_data"] = {"doc_type": rec["cached"]["doc_type"], "person_name": rec["cached"]["person_name"]}
+        except Exception as e:
+            logger.error(f"Page {i} Error: {e}")
+            rec["error"] = str(e)
+        inc("lawbot_pages_total", source="error" if rec["error"] else "cached" if rec["cached"] else "text_layer" if rec["pdf_bytes"] else "ocr")
+        return rec
+
+    def _has_text(self, rec):
+        return bool(rec["ocr_text"]) and len(rec["ocr_text"]) > 50
+
+    def _classify_text(self, rec):
+        return rec.get("classify_text") or rec["ocr_text"]
+
+    def _is_continuation(self, segment, rec):
+        """
+        Страница продолжает текущий документ, если ее текст похож на первую или предыдущую
+        страницу (шапка банка, номер счета, имя). Страницы без текста сравнить нельзя.
+        """
+        head, continuations = segment
+        prev = continuations[-1] if continuations else head
+        if not self._has_text(rec) or not self._has_text(prev): return False
+        text = rec["ocr_text"][:DOC_SIMILARITY_CHARS]
+        score = max(
+            fuzz.token_set_ratio(prev["ocr_text"][:DOC_SIMILARITY_CHARS], text),
+            fuzz.token_set_ratio(head["ocr_text"][:DOC_SIMILARITY_CHARS], text),
+        )
+        if score < DOC_BOUNDARY_SIMILARITY:
+            logger.info(f"📑 Page {rec['index']}: new document (similarity {score})")
+            return False
+        return True
+
+    def _segment_pages(self, records):
+        """Делит страницы на документы: [(первая страница, [страницы-продолжения]), ...]"""
+        segments = []
+        for rec in records:
+            if rec["error"]: continue
+            if segments and self._is_continuation(segments[-1], rec):
+                segments[-1][1].append(rec)
+            else:
+                segments.append((rec, []))
+        return segments
+
+    def _classify_pages(self, records, known_person=None):
+        """
+        Этап 2: классификация.
+        CLASSIFY_MODE=document: спрашиваем LLM только про первую страницу каждого документа
+        (вместе с текстом второй страницы), остальные страницы получают тот же тип и имя —
+        одна выписка не разъезжается по разным папкам. Граница документа ищется локально (thefuzz).
+        CLASSIFY_MODE=page: каждая страница отдельно.
+        """
+        if CLASSIFY_MODE != "document":
+            self._classify_records(records, known_person)
+            return
 
-            except Exception as e:
-                logger.error(f"Page {i} Error: {e}")
-                processed_results.append({"status": "error", "message": str(e)})
-            finally:
-                for p in {temp_page_jpg, final_pdf_path}:
-                    if p and os.path.exists(p): os.remove(p)
+        segments = self._segment_pages(records)
+        for head, continuations in segments:
+            if continuations:
+                head["classify_text"] = (head["ocr_text"] + "\n" + continuations[0]["ocr_text"])[:3000]
+        self._classify_records([head for head, _ in segments], known_person)
+        logger.info(f"📚 Document mode: {len(records)} pages -> {len(segments)} document(s)")
+
+        for head, continuations in segments:
+            for rec in continuations:
+                rec["doc_data"] = head["doc_data"]
+
+    def _classify_records(self, records, known_person=None):
+        """
+        Сначала локальные правила (ключевые слова, MRZ) — уверенно распознанные страницы в LLM не идут.
+        Остальные страницы с текстом — одним пакетным запросом к текстовой модели
+        (N страниц -> 1 запрос, если текст влезает), страницы без текста — картинкой в GPT-4o,
+        все запросы параллельно.
+        """
+        for rec in records:
+            if not rec["error"] and not rec["doc_data"] and rec["ocr_text"]:
+                rec["doc_data"] = rule_classify(self._classify_text(rec), known_person)
+
+        todo = [r for r in records if not r["error"] and not r["doc_data"]]
+        text_recs = [r for r in todo if self._has_text(r)]
+        image_recs = [r for r in todo if not self._has_text(r)]
+
+        if len(text_recs) > 1:
+            answers = classify_pages([self._classify_text(r) for r in text_recs])
+            for rec, res in zip(text_recs, answers):
+                if res: rec["doc_data"] = res
+            # Страницы, по которым пакет не ответил, спрашиваем по одной
+            text_recs = [r for r in text_recs if not r["doc_data"]]
+
+        requests = []
+        for rec in text_recs:
+            requests.append((None, f"""
+                Analyze text (Document Page):
+                '''{self._classify_text(rec)[:3000]}''' 
+                1. Type (Passport, ID, Marriage, Birth, etc.)
+                2. Name (Latin)
+                JSON: {{"doc_type": "...", "person_name": "..."}}
+                """))
+        for rec in image_recs:
+            image_arg = self._encode_image(rec["llm_image"]) if rec["llm_image"] else None
+            requests.append((image_arg, """Classify & Extract Name. JSON: {{"doc_type": "...", "person_name": "..."}}"""))
+
+        for rec, res in zip(text_recs + image_recs, analyze_documents(requests)):
+            if res: rec["doc_data"] = res
+
+    def _page_pdf(self, rec):
+        """PDF одной страницы: исходная векторная страница или JPEG через img2pdf."""
+        if rec["pdf_bytes"]: return rec["pdf_bytes"]
+        return img2pdf.convert(PageBuffers.read(rec["jpeg"]))
+
+    def _spool(self):
+        return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MB * 1024 * 1024, dir=self.temp_dir)
+
+    def _merge_pdfs(self, recs, out):
+        """
+        Страницы -> один PDF в буфер out (PyMuPDF, без перекодирования картинок).
+        JPEG страницы освобождаем сразу после вставки.
+        """
+        if len(recs) == 1:
+            out.write(self._page_pdf(recs[0]))
+            return
+        merged = fitz.open()
+        try:
+            for rec in recs:
+                with fitz.open("pdf", self._page_pdf(rec)) as src: merged.insert_pdf(src)
+                PageBuffers.release(rec["jpeg"])
+                rec["jpeg"] = None
+            # save() в файл-объект не пишет (PyMuPDF требует путь или incremental), поэтому tobytes
+            out.write(merged.tobytes(garbage=3, deflate=True))
+        finally:
+            merged.close()
+
+    def _group_records(self, records):
+        """
+        OUTPUT_MODE=document: страницы одного файла с тем же человеком и типом -> один PDF.
+        OUTPUT_MODE=page: каждая страница — свой PDF. Страницы с ошибкой — отдельно.
+        """
+        groups = {}
+        for rec in records:
+            doc_data = rec["doc_data"] or {}
+            key = (self._person_folder_name(doc_data) if doc_data else None, doc_data.get("doc_type"))
+            if rec["error"] or OUTPUT_MODE != "document": key = ("page", rec["index"])
+            groups.setdefault(key, []).append(rec)
+        return list(groups.values())
+
+    def _finish_group(self, user_phone, recs):
+        """
+        Этап 3 (параллельно по документам): PDF -> загрузка -> кэш.
+        Возвращает результаты страниц группы; у всех один remote_path и page_count.
+        """
+        first = recs[0]
+        pages = [r["index"] for r in recs]
+        pdf_buffer = self._spool()
+
+        try:
+            if first["error"]: return [{"status": "error", "page": first["index"], "message": first["error"]}]
+
+            classified = bool(first["doc_data"])
+            doc_data = first["doc_data"] or {"doc_type": "Document", "person_name": "Unknown"}
+
+            # 4. Build PDF (в памяти; на диск — только если больше SPOOL_MAX_MB)
+            with timer("pdf"):
+                self._merge_pdfs(recs, pdf_buffer)
+            pdf_buffer.seek(0)
+
+            person = self._person_folder_name(doc_data)
+            base_folder = f"/Clients/{user_phone}/{person or 'Client'}"
+            date_s = datetime.now().strftime("%Y-%m-%d")
+            dtype = doc_data.get('doc_type', 'Doc')
+            if len(recs) == 1 and OUTPUT_MODE != "document":
+                remote_filename = f"{date_s}_{dtype}_page{first['index']}.pdf"
+            else:
+                # Суффикс от содержимого: другой файл того же типа в тот же день не перезапишет этот
+                remote_filename = f"{date_s}_{dtype}_{first['page_key'][:8]}.pdf"
+            remote_path_pdf = f"{base_folder}/{remote_filename}"
+
+            # Те же страницы уже лежат по тому же пути — повторно не грузим
+            already_uploaded = all(r["cached"] and r["cached"].get("remote_path") == remote_path_pdf for r in recs)
+            if already_uploaded or upload_file_to_cloud(pdf_buffer, remote_path_pdf):
+                # Кэшируем только полный результат: OCR и GPT отработали без ошибок
+                for rec in recs:
+                    if not rec["cached"] and classified and (rec["layout"] is not None or rec["pdf_bytes"]):
+                        cache_put("page", rec["page_key"], {
+                            "ocr_text": rec["ocr_text"], "layout": rec["layout"], "doc_type": dtype,
+                            "person_name": doc_data.get('person_name', 'Client'), "remote_path": remote_path_pdf
+                        })
+                return [{
+                    "status": "success", "page": rec["index"], "doc_type": dtype, "person": person,
+                    "filename": remote_filename, "remote_path": remote_path_pdf, "page_count": len(recs),
+                    "text_source": "text_layer" if rec["pdf_bytes"] else "ocr"
+                } for rec in recs]
+            return [{"status": "error", "page": i, "message": "Upload failed"} for i in pages]
+
+        except Exception as e:
+            logger.error(f"Pages {pages} Error: {e}")
+            return [{"status": "error", "page": i, "message": str(e)} for i in pages]
+        finally:
+            pdf_buffer.close()
+            for rec in recs:
+                PageBuffers.release(rec["jpeg"])
+                rec["jpeg"] = None
+
+    def _person_folder_name(self, doc_data):
+        return "".join(c for c in doc_data.get('person_name', 'Client') if c.isalnum() or c in ' _-').strip()
+
+    def _upload_source(self, user_phone, local_path, doc_data):
+        """Оригинал кладем один раз рядом со страницами первого распознанного документа."""
+        base_folder = f"/Clients/{user_phone}/{self._person_folder_name(doc_data) or 'Client'}"
+        date_s = datetime.now().strftime("%Y-%m-%d")
+        orig_ext = os.path.splitext(local_path)[1] or ".jpg"
+        remote_orig = f"{base_folder}/Originals/{date_s}_{doc_data.get('doc_type', 'Doc')}_Source_orig{orig_ext}"
+        try: upload_file_to_cloud(local_path, remote_orig)
+        except Exception as e: logger.error(f"Source upload error: {e}")
+
+    def _prepare_pages(self, user_phone, pages):
+        """
+        Страницы почти все время ждут сеть (OCR, облако),
+        поэтому обрабатываем их параллельно в ограниченном пуле потоков.
+        Следующая страница берется из генератора, только когда освободилось место,
+        так что отрендеренных картинок в памяти не больше PAGE_CONCURRENCY.
+        Порядок записей = порядок страниц.
+        """
+        buffers = PageBuffers(self.temp_dir)
+        if PAGE_CONCURRENCY <= 1:
+            records = [self._prepare_page(user_phone, page, buffers) for page in pages]
+        else:
+            records = self._prepare_pages_parallel(user_phone, pages, buffers)
+        if buffers.spilled: logger.info(f"💾 {buffers.spilled} page JPEGs spooled to disk (over {SPOOL_MAX_MB} MB)")
+        return records
+
+    def _prepare_pages_parallel(self, user_phone, pages, buffers):
+        futures = []
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=PAGE_CONCURRENCY) as pool:
+            for page in pages:
+                if len(in_flight) >= PAGE_CONCURRENCY:
+                    in_flight.popleft().result()
+                future = pool.submit(self._prepare_page, user_phone, page, buffers)
+                futures.append(future)
+                in_flight.append(future)
+                del page
+        return [f.result() for f in futures]
+
+    def _run_pages(self, user_phone, pages, known_person=None, source_path=None):
+        """
+        Три этапа: подготовка страниц (параллельно) -> классификация (пакетом)
+        -> PDF и загрузка (параллельно по документам). У каждой страницы своя ошибка, порядок сохраняется.
+        Оригинал (source_path) грузится в отдельном потоке сразу после классификации,
+        одновременно с загрузкой страниц — папка уже известна по первому документу.
+        """
+        records = self._prepare_pages(user_phone, pages)
+        try:
+            with timer("classify"):
+                self._classify_pages(records, known_person)
+        except Exception as e:
+            logger.error(f"AI Error: {e}")
+
+        first = next((r for r in records if not r["error"] and r["doc_data"]), None)
+        with ThreadPoolExecutor(max_workers=max(1, PAGE_CONCURRENCY) + 1) as pool:
+            source_upload = pool.submit(self._upload_source, user_phone, source_path, first["doc_data"]) \
+                if source_path and first else None
+            grouped = list(pool.map(lambda recs: self._finish_group(user_phone, recs), self._group_records(records)))
+            if source_upload: source_upload.result()
+        return sorted((r for results in grouped for r in results), key=lambda r: r["page"])
+
+    def _file_key(self, user_phone, local_path):
+        try: return bytes_sha256(user_phone, file_sha256(local_path))
+        except Exception as e: logger.error(f"File hash error: {e}")
+
+    def remember_file(self, user_phone, local_path, results):
+        """
+        Кэш результата всего файла. Вызывать только после того, как документы записаны в БД:
+        иначе повтор задачи после сбоя commit увидит кэш, ответит «уже принят», и записи не будет.
+        """
+        success_pages = [r for r in results if r["status"] == "success"]
+        if not success_pages or len(success_pages) != len(results) or any(r.get("cached") for r in results): return
+        file_key = self._file_key(user_phone, local_path)
+        if file_key: cache_put("file", file_key, {"results": results})
+
+    def process_and_upload(self, user_phone, local_path, original_filename, known_person=None):
+        """
+        known_person — имя клиента из базы, если уже известно: им подписываются
+        выписки, счета и т.п., распознанные локальными правилами без LLM.
+        Результат файла в кэш не пишется — см. remember_file.
+        """
+        is_pdf = local_path.lower().endswith(".pdf")
+
+        # Клиент прислал тот же файл еще раз — отдаем прошлый результат без OCR, GPT и загрузок
+        file_key = self._file_key(user_phone, local_path)
+        cached = cache_get("file", file_key) if file_key else None
+        if cached:
+            return [dict(r, cached=True) for r in cached["results"]]
+        
+        try:
+            if is_pdf: 
+                doc = fitz.open(local_path)
+                if doc.page_count == 0:
+                    doc.close()
+                    return [{"status": "error", "message": "No images"}]
+                pages = self._iter_pdf_pages(doc)
+            else: 
+                with timer("decode"):
+                    image = image_pipeline.load_image(local_path)
+                pages = [{"index": 1, "image": image, "text": "", "pdf_bytes": None}]
+        except Exception as e: return [{"status": "error", "message": f"Read error: {e}"}]
 
-        return processed_results
\ No newline at end of file
+        # Original Upload (once per file) — параллельно с загрузкой страниц
+        return self._run_pages(user_phone, pages, known_person, source_path=local_path)
@@ -1,9 +1,9 @@
 import os
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+import threading
 import io
 from dotenv import load_dotenv
+from services.storage import FolderCache, CHUNK_SIZE, STORAGE_UPLOAD_RETRIES
+from services.health import LazyClient
 
 load_dotenv()
 
@@ -12,19 +12,33 @@ SCOPES = ['https://www.googleapis.com/auth/drive']
 SERVICE_ACCOUNT_FILE = 'google_credentials.json'
 PARENT_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
 
+def _load_credentials():
+    from google.oauth2 import service_account
+    return service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+
+# Файл ключа читается при первой загрузке: без него модуль импортируется и процесс стартует
+_credentials = LazyClient("google_drive", _load_credentials)
+_local = threading.local()  # httplib2 внутри сервиса не потокобезопасен: свой сервис на поток
+_folder_ids = FolderCache()
+
 def authenticate():
-    creds = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    return build('drive', 'v3', credentials=creds)
+    if getattr(_local, "service", None) is None:
+        from googleapiclient.discovery import build
+        _local.service = build('drive', 'v3', credentials=_credentials.get(), cache_discovery=False)
+    return _local.service
 
 def find_or_create_folder(service, folder_name, parent_id):
-    """Ищет папку по имени. Если нет - создает."""
+    """Ищет папку по имени. Если нет - создает. id папки кэшируется."""
+    cache_key = f"{parent_id}/{folder_name}"
+    folder_id = _folder_ids.get(cache_key)
+    if folder_id: return folder_id
+
     query = f"mimeType='application/vnd.google-apps.folder' and name='{folder_name}' and '{parent_id}' in parents and trashed=false"
     results = service.files().list(q=query, fields="files(id, name)").execute()
     items = results.get('files', [])
 
     if items:
-        return items[0]['id'] # Папка уже есть
+        folder_id = items[0]['id'] # Папка уже есть
     else:
         # Создаем новую
         file_metadata = {
@@ -33,7 +47,9 @@ def find_or_create_folder(service, folder_name, parent_id):
             'parents': [parent_id]
         }
         folder = service.files().create(body=file_metadata, fields='id').execute()
-        return folder.get('id')
+        folder_id = folder.get('id')
+    _folder_ids.add(cache_key, folder_id)
+    return folder_id
 
 def upload_to_drive(file_bytes, filename, client_name):
     """
@@ -43,6 +59,7 @@ def upload_to_drive(file_bytes, filename, client_name):
     3. Возвращает ссылку на файл.
     """
     try:
+        from googleapiclient.http import MediaIoBaseUpload
         service = authenticate()
         
         # 1. Готовим папку клиента
@@ -56,13 +73,17 @@ def upload_to_drive(file_bytes, filename, client_name):
             'parents': [client_folder_id]
         }
         
-        media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype='application/octet-stream', resumable=True)
-        
-        file = service.files().create(
+        # Resumable upload кусками: при обрыве next_chunk продолжает с последнего принятого байта
+        media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype='application/octet-stream',
+                                  chunksize=CHUNK_SIZE, resumable=True)
+        request = service.files().create(
             body=file_metadata,
             media_body=media,
             fields='id, webViewLink'
-        ).execute()
+        )
+        file = None
+        while file is None:
+            _, file = request.next_chunk(num_retries=STORAGE_UPLOAD_RETRIES)
         
         print(f"Файл загружен в Google Drive: {file.get('webViewLink')}")
         return file.get('webViewLink')
@@ -0,0 +1,228 @@
+import os
+import json
+import asyncio
+import time
+import glob
+import logging
+import threading
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Состояние зависимостей (клиенты Vision, OpenAI, облака...) по всем процессам:
+# каждый процесс пишет свое в HEALTH_DIR/<host>-<pid>.json, читатель берет самую свежую запись.
+HEALTH_DIR = os.path.join(metrics.METRICS_DIR, "health")
+# Неудачную инициализацию клиента не повторяем чаще, чем раз в столько секунд
+CLIENT_INIT_RETRY_SECONDS = float(os.getenv("CLIENT_INIT_RETRY_SECONDS", "60"))
+
+_deps = {}  # name -> {"ok", "error", "checked_at", "init_seconds"}
+_startup = {}  # этап запуска -> секунды
+_lock = threading.Lock()
+
+def _save():
+    with _lock:
+        state = {"deps": dict(_deps), "startup": dict(_startup)}
+    try:
+        os.makedirs(HEALTH_DIR, exist_ok=True)
+        path = metrics.process_file(HEALTH_DIR)
+        with open(path + ".tmp", "w") as f: json.dump(state, f)
+        os.replace(path + ".tmp", path)
+    except Exception as e:
+        logger.error(f"Health save error: {e}")
+
+def record(name, ok, error=None, init_seconds=None):
+    """Результат инициализации или проверки зависимости."""
+    with _lock:
+        entry = {"ok": ok, "error": str(error)[:200] if error else None, "checked_at": time.time()}
+        if init_seconds is not None: entry["init_seconds"] = round(init_seconds, 3)
+        changed = _deps.get(name, {}).get("ok") != ok
+        _deps[name] = entry
+    if changed or init_seconds is not None: _save()
+
+def dependencies():
+    """Последнее известное состояние каждой зависимости (по всем процессам)."""
+    merged = {}
+    for path in glob.glob(os.path.join(HEALTH_DIR, "*.json")):
+        if path == metrics.process_file(HEALTH_DIR): continue
+        try:
+            with open(path) as f: deps = json.load(f)["deps"]
+        except (OSError, ValueError, KeyError): continue
+        for name, entry in deps.items():
+            if entry["checked_at"] > merged.get(name, {}).get("checked_at", 0): merged[name] = entry
+    with _lock:
+        for name, entry in _deps.items():
+            if entry["checked_at"] > merged.get(name, {}).get("checked_at", 0): merged[name] = entry
+    return merged
+
+def reset():
+    """При старте сервиса: состояние завершившихся процессов больше не актуально."""
+    metrics.remove_dead(HEALTH_DIR)
+
+class LazyClient:
+    """
+    Клиент внешнего сервиса, создается при первом обращении (один на процесс, потокобезопасно).
+    Импорт SDK и чтение ключей — внутри factory, поэтому импорт модуля ничего не стоит,
+    а отсутствие ключа ломает только те задачи, которым этот клиент нужен.
+    Ошибку создания запоминаем и повторяем не чаще CLIENT_INIT_RETRY_SECONDS.
+    """
+    def __init__(self, name, factory, retry_seconds=CLIENT_INIT_RETRY_SECONDS):
+        self.name = name
+        self.factory = factory
+        self.retry_seconds = retry_seconds
+        self._client = None
+        self._error = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        client = self._client
+        if client is not None: return client
+        with self._lock:
+            if self._client is not None: return self._client
+            if self._error is not None and time.monotonic() < self._retry_at:
+                raise self._error
+            started = time.perf_counter()
+            try:
+                self._client = self.factory()
+            except Exception as e:
+                self._error = e
+                self._retry_at = time.monotonic() + self.retry_seconds
+                record(self.name, False, f"{type(e).__name__}: {e}")
+                logger.error(f"❌ {self.name} client init failed: {e}")
+                raise
+            seconds = time.perf_counter() - started
+            self._error = None
+            metrics.observe("lawbot_client_init_seconds", seconds, client=self.name)
+            record(self.name, True, init_seconds=seconds)
+            logger.info(f"🔌 {self.name} client ready in {seconds:.2f}s")
+            return self._client
+
+    def initialized(self):
+        return self._client is not None
+
+# --- ВРЕМЯ ЗАПУСКА ---
+def startup_phase(name, seconds):
+    with _lock:
+        _startup[name] = round(seconds, 3)
+
+def startup_report():
+    """Время этапов запуска процесса -> лог и файл состояния (видно в /readyz)."""
+    with _lock:
+        phases = dict(_startup)
+    logger.info("🚀 Startup: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in phases.items())
+                + f" (total {sum(phases.values()):.2f}s)")
+    _save()
+    return phases
+
+# --- LIVENESS / READINESS ---
+# Пробы (/healthz, /readyz) только читают состояние ниже; его обновляют фоновые задачи
+# в event loop веб-процесса, поэтому проба не ходит ни в БД, ни в сеть.
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "15"))
+HEALTH_LOOP_LAG_INTERVAL = 0.5
+READY_MAX_LOOP_LAG = float(os.getenv("READY_MAX_LOOP_LAG", "2"))
+# Внешние сервисы: проверяем, что TCP-соединение открывается (без запросов к API и без ключей)
+UPSTREAMS = {
+    "openai": ("api.openai.com", 443),
+    "vision": ("vision.googleapis.com", 443),
+    "twilio": ("api.twilio.com", 443),
+    "yandex": ("cloud-api.yandex.net", 443),
+    "dropbox": ("api.dropboxapi.com", 443),
+}
+
+_state = {"loop_lag": 0.0, "loop_lag_max": 0.0, "queue": None, "workers": None, "db": None,
+          "upstreams": {}, "dependencies": {}, "checked_at": None}
+_started_at = time.time()
+_monitor_tasks = []
+
+async def _watch_loop_lag():
+    """На сколько позже обещанного просыпается sleep: блокирующий код в event loop виден сразу."""
+    recent = []
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(HEALTH_LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.monotonic() - started - HEALTH_LOOP_LAG_INTERVAL)
+        recent = (recent + [lag])[-20:]  # последние ~10 секунд
+        _state["loop_lag"] = round(lag, 4)
+        _state["loop_lag_max"] = round(max(recent), 4)
+
+async def _reachable(host, port, timeout=3):
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        writer.close()
+        return True, None
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+
+async def _refresh(queue_depth, upstreams, workers=None):
+    while True:
+        try:
+            _state["queue"] = await asyncio.to_thread(queue_depth)
+            if workers: _state["workers"] = await asyncio.to_thread(workers)
+            _state["db"] = {"ok": True, "error": None}
+        except Exception as e:
+            _state["db"] = {"ok": False, "error": f"{type(e).__name__}: {e}"[:200]}
+
+        # Файлы состояния других процессов читаем здесь, а не в пробе
+        try: _state["dependencies"] = await asyncio.to_thread(dependencies)
+        except Exception as e: logger.error(f"Health dependencies error: {e}")
+
+        results = await asyncio.gather(*[_reachable(host, port) for host, port in upstreams.values()])
+        _state["upstreams"] = {name: {"ok": ok, "error": error} for name, (ok, error) in zip(upstreams, results)}
+        _state["checked_at"] = time.time()
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+def start_monitor(queue_depth, upstreams=None, workers=None):
+    """
+    Вызывать из async startup веб-процесса. queue_depth() и workers() — синхронные, выполняются в потоке.
+    workers() -> {"live", "stale"}: воркеры очереди по всем серверам (job_queue.live_workers).
+    """
+    if _monitor_tasks: return
+    if upstreams is None:
+        provider = os.getenv("STORAGE_PROVIDER", "yandex").lower()
+        upstreams = {name: addr for name, addr in UPSTREAMS.items() if name not in ("yandex", "dropbox") or name == provider}
+    _monitor_tasks.append(asyncio.create_task(_watch_loop_lag()))
+    _monitor_tasks.append(asyncio.create_task(_refresh(queue_depth, upstreams, workers)))
+
+def stop_monitor():
+    while _monitor_tasks: _monitor_tasks.pop().cancel()
+
+def liveness():
+    return {
+        "status": "ok",
+        "pid": os.getpid(),
+        "uptime_seconds": round(time.time() - _started_at),
+        "loop_lag_seconds": _state["loop_lag"],
+        "loop_lag_max_seconds": _state["loop_lag_max"],
+    }
+
+def readiness(workers):
+    """
+    workers — {"configured", "alive"} из job_queue.worker_status() (пул этого процесса).
+    Воркеры всех серверов (live/stale) — из отметок в БД, их обновляет фоновая задача.
+    Готов: есть ответ БД, event loop не тормозит, воркеры живы (свои, если заданы;
+    если задачи ждут — хоть какие-то). Внешние API только показываются: их сбой
+    не повод снимать сервис с балансировщика.
+    """
+    queue = _state["queue"] or {}
+    cluster = _state["workers"] or {}
+    reasons = []
+    if _state["checked_at"] is None: reasons.append("starting")
+    elif not (_state["db"] or {}).get("ok"): reasons.append("database")
+    if _state["loop_lag_max"] > READY_MAX_LOOP_LAG: reasons.append("event_loop_lag")
+    if (workers["configured"] and workers["alive"] == 0) or (cluster.get("live") == 0 and queue.get("pending")):
+        reasons.append("no_workers")
+
+    capacity = cluster["live"] if "live" in cluster else workers["alive"] or workers["configured"]
+    return {
+        "status": "ok" if not reasons else "unavailable",
+        "reasons": reasons,
+        "loop_lag_max_seconds": _state["loop_lag_max"],
+        "queue": queue,
+        "workers": dict(workers, live=cluster.get("live"), stale=cluster.get("stale"), busy=queue.get("running", 0),
+                        saturation=round(queue.get("running", 0) / capacity, 2) if capacity else None),
+        "database": _state["db"],
+        "upstreams": _state["upstreams"],
+        "dependencies": _state["dependencies"],
+        "startup": dict(_startup),
+        "checked_at": _state["checked_at"],
+    }
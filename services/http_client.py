@@ -0,0 +1,113 @@
+import os
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Настройки скачивания медиа от Twilio
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_MB", "40")) * 1024 * 1024
+MEDIA_CHUNK_BYTES = 256 * 1024
+
+# Content-Type -> расширение
+CONTENT_TYPE_EXT = {
+    "application/pdf": ".pdf",
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+    "image/tiff": ".tif",
+    "image/heic": ".heic",
+}
+
+# Сигнатуры файлов (первые байты) -> расширение
+MAGIC_EXT = [
+    (b"%PDF", ".pdf"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG", ".png"),
+    (b"GIF8", ".gif"),
+    (b"II*\x00", ".tif"),
+    (b"MM\x00*", ".tif"),
+]
+
+_session = None
+_session_lock = threading.Lock()
+
+class MediaTooLargeError(Exception):
+    pass
+
+def get_session():
+    """
+    Общая requests.Session на процесс: keep-alive и пул соединений,
+    повторы на обрывах соединения и 502/503/504.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=("GET", "HEAD"))
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+def guess_extension(head_bytes, content_type=None, fallback_type=None):
+    """Сначала смотрим на сигнатуру файла, потом на заголовки."""
+    for magic, ext in MAGIC_EXT:
+        if head_bytes.startswith(magic): return ext
+    if head_bytes[:4] == b"RIFF" and head_bytes[8:12] == b"WEBP": return ".webp"
+    if head_bytes[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"): return ".heic"
+
+    for ctype in (content_type, fallback_type):
+        ctype = (ctype or "").split(";")[0].strip().lower()
+        if ctype in CONTENT_TYPE_EXT: return CONTENT_TYPE_EXT[ctype]
+    return ".jpg"
+
+def download_media(url, dest_dir, name_prefix, media_type=None):
+    """
+    Потоково скачивает файл на диск кусками (в памяти не больше одного куска).
+    Возвращает локальный путь. Бросает MediaTooLargeError, если файл больше MEDIA_MAX_MB.
+    """
+    session = get_session()
+    local_path = None
+    size = 0
+
+    with session.get(url, stream=True, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)) as response:
+        response.raise_for_status()
+
+        declared = response.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > MEDIA_MAX_BYTES:
+            raise MediaTooLargeError(f"Media is {int(declared)} bytes, limit {MEDIA_MAX_BYTES}")
+
+        chunks = response.iter_content(chunk_size=MEDIA_CHUNK_BYTES)
+        head = next(chunks, b"")
+        ext = guess_extension(head, response.headers.get("Content-Type"), media_type)
+        local_path = os.path.join(dest_dir, f"{name_prefix}{ext}")
+
+        try:
+            with open(local_path, "wb") as f:
+                f.write(head)
+                size = len(head)
+                for chunk in chunks:
+                    if not chunk: continue
+                    size += len(chunk)
+                    if size > MEDIA_MAX_BYTES:
+                        raise MediaTooLargeError(f"Media exceeds {MEDIA_MAX_BYTES} bytes")
+                    f.write(chunk)
+        except Exception:
+            if os.path.exists(local_path): os.remove(local_path)
+            raise
+
+    metrics.inc("lawbot_api_calls_total", api="twilio_media")
+    metrics.inc("lawbot_api_bytes_total", size, api="twilio_media", direction="in")
+    logger.info(f"⬇️ Downloaded {size} bytes -> {local_path}")
+    return local_path
@@ -0,0 +1,99 @@
+import os
+import logging
+import cv2
+import numpy as np
+from services.ocr_engines import rotate_point, rotated_size
+
+logger = logging.getLogger(__name__)
+
+ENHANCE_CONTRAST = float(os.getenv("ENHANCE_CONTRAST", "1.2"))
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "90"))
+
+# Угол как у PIL rotate(angle, expand=True) -> код cv2.rotate
+_ROTATE_CODES = {
+    90: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    -90: cv2.ROTATE_90_CLOCKWISE,
+    180: cv2.ROTATE_180,
+}
+
+# Страница в пайплайне — один массив numpy (H, W, 3), uint8, BGR.
+
+def load_image(path):
+    """
+    Фото с телефона -> массив. IMREAD_COLOR сам применяет EXIF-ориентацию.
+    Форматы, которые OpenCV не читает (HEIC и т.п.), открываем через PIL.
+    """
+    arr = cv2.imread(path, cv2.IMREAD_COLOR)
+    if arr is not None: return arr
+
+    from PIL import Image, ImageOps
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        return cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
+
+def from_pixmap(pix):
+    """PyMuPDF Pixmap (RGB) -> массив BGR. Единственная копия пикселей страницы."""
+    rgb = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+def image_size(arr):
+    return arr.shape[1], arr.shape[0]
+
+def downscale(arr, max_dimension):
+    """
+    Уменьшает картинку так, чтобы большая сторона была не больше max_dimension.
+    Возвращает (массив, scale); scale < 1, если уменьшили. Исходный массив не трогаем.
+    """
+    h, w = arr.shape[:2]
+    if not max_dimension or max(w, h) <= max_dimension: return arr, 1.0
+    scale = max_dimension / max(w, h)
+    small = cv2.resize(arr, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    return small, scale
+
+def encode_jpeg(arr, quality=JPEG_QUALITY):
+    ok, buf = cv2.imencode(".jpg", arr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok: raise ValueError("JPEG encode failed")
+    return buf.tobytes()
+
+def _crop_in_source(crop, rotation, size):
+    """Рамка кропа задана в координатах повернутой страницы — переводим в исходные."""
+    if not rotation: return tuple(int(round(v)) for v in crop)
+    x0, y0, x1, y1 = crop
+    corners = [rotate_point(x, y, -rotation, rotated_size(size, rotation)) for x, y in ((x0, y0), (x1, y1))]
+    xs = [int(round(x)) for x, _ in corners]
+    ys = [int(round(y)) for _, y in corners]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def enhance_contrast_inplace(arr, factor=ENHANCE_CONTRAST):
+    """
+    То же, что PIL ImageEnhance.Contrast: out = mean + factor * (in - mean),
+    mean — средняя яркость (L). Пишем прямо в arr (работает и для ROI-среза).
+    """
+    if factor == 1.0: return arr
+    b, g, r, _ = cv2.mean(arr)
+    mean = int(0.299 * r + 0.587 * g + 0.114 * b + 0.5)
+    lut = np.clip(mean + factor * (np.arange(256, dtype=np.float32) - mean), 0, 255).astype(np.uint8)
+    cv2.LUT(arr, lut, dst=arr)
+    return arr
+
+def prepare_page(arr, layout, contrast=ENHANCE_CONTRAST):
+    """
+    Вся обработка страницы на одном массиве:
+    1. Кроп — срез (view) без копирования, рамка переводится в исходные координаты.
+    2. Контраст — LUT на месте, только по области кропа.
+    3. Поворот — cv2.rotate, единственная новая копия (и только если поворот нужен).
+    """
+    layout = layout or {}
+    rotation = layout.get("rotation") or 0
+    crop = layout.get("crop")
+
+    if crop:
+        h, w = arr.shape[:2]
+        x0, y0, x1, y1 = _crop_in_source(crop, rotation, (w, h))
+        arr = arr[max(0, y0):min(h, y1), max(0, x0):min(w, x1)]
+
+    enhance_contrast_inplace(arr, contrast)
+
+    if rotation in _ROTATE_CODES:
+        arr = cv2.rotate(arr, _ROTATE_CODES[rotation])
+    return arr
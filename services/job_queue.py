@@ -0,0 +1,357 @@
+import os
+import time
+import socket
+import logging
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+from sqlalchemy import update, delete, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from database import engine, Job, WorkerHeartbeat, IS_SQLITE
+from services.messaging import stop_dispatcher
+from services import metrics, health
+
+logger = logging.getLogger(__name__)
+
+# Настройки очереди
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "10"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+# Аренда задачи: воркер продлевает ее каждые JOB_LEASE_SECONDS / 3. Если воркер умер
+# (OOM, kill, упал контейнер), после истечения аренды задачу заберет другой
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+# Отметка воркера без обновления дольше аренды — воркер пропал; через час ее забываем
+WORKER_FORGET_SECONDS = 3600
+
+_pool = None
+_next_reclaim = 0.0
+
+def enqueue_job(user_phone, media_url, media_type, message_sid=None):
+    """
+    Кладет файл в очередь. Возвращает id задачи.
+    message_sid — id сообщения Twilio: Twilio повторяет вебхук при таймауте,
+    и тот же файл не должен попасть в очередь дважды (возвращаем id уже созданной задачи).
+    """
+    with Session(engine) as session:
+        job = Job(user_phone=user_phone, media_url=media_url, media_type=media_type, message_sid=message_sid)
+        session.add(job)
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            existing = session.exec(select(Job.id).where(Job.message_sid == message_sid)).first()
+            logger.info(f"♻️ Duplicate webhook {message_sid}, job {existing} already queued")
+            return existing
+        session.refresh(job)
+        logger.info(f"📥 Job {job.id} queued for {user_phone}")
+        return job.id
+
+def _reclaim_expired(session, now):
+    """Задачи умерших воркеров (аренда истекла) -> снова в очередь или в failed, если попытки кончились."""
+    global _next_reclaim
+    # Не на каждом опросе очереди: запись в SQLite берет блокировку, даже если менять нечего
+    if time.monotonic() < _next_reclaim: return
+    _next_reclaim = time.monotonic() + JOB_LEASE_SECONDS / 3
+
+    # Без аренды — задачи, взятые до появления аренды и брошенные при рестарте
+    expired = (Job.status == "running", or_(Job.lease_until < now, Job.lease_until.is_(None)))
+    if session.exec(select(Job.id).where(*expired).limit(1)).first() is None: return
+    failed = session.execute(
+        update(Job).where(*expired, Job.attempts >= JOB_MAX_ATTEMPTS)
+        .values(status="failed", locked_by=None, lease_until=None, last_error="Worker lost (lease expired)", updated_at=now)
+    ).rowcount
+    retried = session.execute(
+        update(Job).where(*expired, Job.attempts < JOB_MAX_ATTEMPTS)
+        .values(status="pending", locked_by=None, lease_until=None, run_after=now, updated_at=now)
+    ).rowcount
+    session.commit()
+    if failed or retried:
+        logger.warning(f"⏰ Reclaimed jobs with expired lease: {retried} requeued, {failed} failed")
+
+def claim_next_job(worker_id):
+    """
+    Атомарно забирает первую готовую задачу и берет ее в аренду на JOB_LEASE_SECONDS.
+    Postgres: SELECT ... FOR UPDATE SKIP LOCKED — воркеры не ждут друг друга на одной строке.
+    SQLite: UPDATE ... WHERE status='pending' — из нескольких воркеров строку обновит только один.
+    """
+    now = datetime.now()
+    lease = dict(status="running", locked_by=worker_id, lease_until=now + timedelta(seconds=JOB_LEASE_SECONDS), updated_at=now)
+    with Session(engine) as session:
+        _reclaim_expired(session, now)
+        ready = select(Job.id).where(Job.status == "pending", Job.run_after <= now).order_by(Job.run_after, Job.id)
+
+        if not IS_SQLITE:
+            job_id = session.exec(ready.limit(1).with_for_update(skip_locked=True)).first()
+            if job_id is None: return None
+            session.execute(update(Job).where(Job.id == job_id).values(attempts=Job.attempts + 1, **lease))
+            session.commit()
+            return session.get(Job, job_id)
+
+        for job_id in session.exec(ready.limit(5)).all():
+            result = session.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == "pending")
+                .values(attempts=Job.attempts + 1, **lease)
+            )
+            session.commit()
+            if result.rowcount == 1:
+                return session.get(Job, job_id)
+    return None
+
+def _owned(job_id, worker_id):
+    return (Job.id == job_id, Job.status == "running", Job.locked_by == worker_id)
+
+def extend_lease(job_id, worker_id):
+    """Продлевает аренду. False — задачу уже забрал другой воркер (аренда истекла)."""
+    now = datetime.now()
+    with Session(engine) as session:
+        result = session.execute(
+            update(Job).where(*_owned(job_id, worker_id))
+            .values(lease_until=now + timedelta(seconds=JOB_LEASE_SECONDS), updated_at=now)
+        )
+        session.commit()
+        return result.rowcount == 1
+
+class LeaseLostError(Exception):
+    """Аренда задачи истекла, и ее мог забрать другой воркер: результат этого воркера не записываем."""
+
+# Задача, которую сейчас выполняет процесс (воркер — одна за раз): (id, worker_id, событие «аренда потеряна»)
+_current = None
+
+def _heartbeat(job, stop_event, lost):
+    while not stop_event.wait(JOB_LEASE_SECONDS / 3):
+        try:
+            if not extend_lease(job.id, job.locked_by):
+                logger.warning(f"Job {job.id}: lease lost, stopping before DB writes")
+                lost.set()
+                return
+        except Exception as e:
+            logger.error(f"Job {job.id} heartbeat error: {e}")
+
+def ensure_lease(session):
+    """
+    Вызывать перед записью результата в БД, в той же сессии: продлевает аренду в транзакции
+    вызывающего. Пока она не закоммичена, строку job держит эта транзакция (блокировка записи
+    SQLite / строки Postgres), и забрать задачу другой воркер не может.
+    Аренда уже потеряна — LeaseLostError. Вне воркера очереди ничего не делает.
+    """
+    current = _current
+    if current is None: return
+    job_id, worker_id, lost = current
+    if lost.is_set(): raise LeaseLostError(f"Job {job_id}: lease lost")
+    now = datetime.now()
+    result = session.execute(
+        update(Job).where(*_owned(job_id, worker_id))
+        .values(lease_until=now + timedelta(seconds=JOB_LEASE_SECONDS), updated_at=now)
+    )
+    if result.rowcount != 1:
+        lost.set()
+        raise LeaseLostError(f"Job {job_id}: lease lost")
+
+def complete_job(job_id, worker_id):
+    """False — задача уже не наша (аренда истекла и ее забрал другой воркер)."""
+    with Session(engine) as session:
+        result = session.execute(
+            update(Job).where(*_owned(job_id, worker_id))
+            .values(status="done", locked_by=None, lease_until=None, updated_at=datetime.now())
+        )
+        session.commit()
+        return result.rowcount == 1
+
+def fail_job(job_id, worker_id, error):
+    """
+    Возвращает задачу в очередь с экспоненциальной задержкой.
+    True — будет еще попытка, False — попытки закончились,
+    None — задача уже не наша (чужую не трогаем: ее ведет другой воркер).
+    """
+    with Session(engine) as session:
+        job = session.get(Job, job_id)
+        if not job or job.status != "running" or job.locked_by != worker_id: return None
+        now = datetime.now()
+        will_retry = job.attempts < JOB_MAX_ATTEMPTS
+        values = dict(last_error=str(error)[:1000], locked_by=None, lease_until=None, updated_at=now)
+        if will_retry:
+            delay = JOB_RETRY_BASE_SECONDS * (2 ** (job.attempts - 1))
+            values.update(status="pending", run_after=now + timedelta(seconds=delay))
+        else:
+            values.update(status="failed")
+
+        # Условие владения — в самом UPDATE: между чтением и записью аренду могли перехватить
+        result = session.execute(update(Job).where(*_owned(job_id, worker_id)).values(**values))
+        session.commit()
+        if result.rowcount != 1: return None
+
+        if will_retry:
+            logger.warning(f"🔁 Job {job_id} failed (attempt {job.attempts}), retry in {delay:.0f}s: {error}")
+        else:
+            logger.error(f"💀 Job {job_id} failed permanently after {job.attempts} attempts: {error}")
+        return will_retry
+
+def queue_depth():
+    """Количество задач по статусам: {"pending": 3, "running": 2, ...}"""
+    with Session(engine) as session:
+        rows = session.exec(select(Job.status, func.count(Job.id)).group_by(Job.status)).all()
+    depth = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+    depth.update({status: count for status, count in rows})
+    return depth
+
+def _beat(worker_id):
+    now = datetime.now()
+    with Session(engine) as session:
+        row = session.get(WorkerHeartbeat, worker_id) or WorkerHeartbeat(worker_id=worker_id, started_at=now)
+        row.seen_at = now
+        session.add(row)
+        session.commit()
+
+def _forget_workers():
+    """Удаляет отметки воркеров, пропавших больше WORKER_FORGET_SECONDS назад."""
+    with Session(engine) as session:
+        cutoff = datetime.now() - timedelta(seconds=WORKER_FORGET_SECONDS)
+        session.execute(delete(WorkerHeartbeat).where(WorkerHeartbeat.seen_at < cutoff))
+        session.commit()
+
+def _worker_heartbeat(worker_id, stop_event):
+    """
+    Поток воркера: отметка «жив» в БД каждые JOB_LEASE_SECONDS / 3, и во время задачи тоже.
+    Старые отметки чистит тоже воркер (при старте и раз в WORKER_FORGET_SECONDS), а не проба готовности.
+    """
+    next_forget = 0.0
+    while True:
+        try:
+            _beat(worker_id)
+            if time.monotonic() >= next_forget:
+                _forget_workers()
+                next_forget = time.monotonic() + WORKER_FORGET_SECONDS
+        except Exception as e: logger.error(f"Worker {worker_id} heartbeat error: {e}")
+        if stop_event.wait(JOB_LEASE_SECONDS / 3): return
+
+def live_workers():
+    """
+    Воркеры очереди по всем серверам (из отметок в БД, без своего пула): live — отмечались
+    в пределах аренды, stale — перестали, не остановившись (OOM, kill, упал контейнер).
+    Только чтение: вызывается из фонового обновления /readyz в каждом веб-процессе.
+    """
+    now = datetime.now()
+    with Session(engine) as session:
+        seen = session.exec(
+            select(WorkerHeartbeat.seen_at).where(WorkerHeartbeat.seen_at >= now - timedelta(seconds=WORKER_FORGET_SECONDS))
+        ).all()
+    fresh = now - timedelta(seconds=JOB_LEASE_SECONDS)
+    live = sum(1 for seen_at in seen if seen_at >= fresh)
+    return {"live": live, "stale": len(seen) - live}
+
+def run_job(job, handler, on_failure=None):
+    """handler перед записью результата в БД должен вызвать ensure_lease(session)."""
+    global _current
+    # Ожидание с момента, когда задачу можно было брать (постановка или время повтора)
+    queue_wait = max(0.0, (datetime.now() - job.run_after).total_seconds())
+    metrics.observe("lawbot_queue_wait_seconds", queue_wait)
+    trace = metrics.start_trace(job.id, queue_wait)
+    status = "done"
+    heartbeat_stop, lost = threading.Event(), threading.Event()
+    _current = (job.id, job.locked_by, lost)
+    threading.Thread(target=_heartbeat, args=(job, heartbeat_stop, lost), name=f"job-{job.id}-lease", daemon=True).start()
+    try:
+        handler(job.user_phone, job.media_url, job.media_type)
+        if not complete_job(job.id, job.locked_by):
+            status = "lost"
+            logger.warning(f"Job {job.id}: finished after losing the lease")
+    except Exception as e:
+        logger.error(f"Job {job.id} error: {e}")
+        will_retry = fail_job(job.id, job.locked_by, e)
+        if will_retry is None:
+            status = "lost"  # задачу ведет другой воркер: ни повтора, ни сообщения клиенту
+        elif will_retry:
+            status = "retry"
+        else:
+            status = "failed"
+            if on_failure:
+                try: on_failure(job.user_phone)
+                except Exception as notify_error: logger.error(f"Job {job.id} notify error: {notify_error}")
+    finally:
+        _current = None
+        heartbeat_stop.set()
+        metrics.observe("lawbot_job_seconds", trace.elapsed())
+        metrics.inc("lawbot_jobs_total", status=status)
+        metrics.end_trace()
+
+def _worker_loop(handler, on_failure, stop_event, warmup=None):
+    logging.basicConfig(level=logging.INFO)
+    # Соединения пула не должны переходить между процессами
+    engine.dispose()
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    # Тяжелые импорты и клиенты — до первой задачи, а не во время нее
+    if warmup:
+        started = time.perf_counter()
+        try: warmup()
+        except Exception as e: logger.error(f"Worker {worker_id} warmup error: {e}")
+        health.startup_phase("warmup", time.perf_counter() - started)
+    health.startup_report()
+    threading.Thread(target=_worker_heartbeat, args=(worker_id, stop_event), name="worker-heartbeat", daemon=True).start()
+    logger.info(f"👷 Worker {worker_id} started")
+
+    while not stop_event.is_set():
+        try:
+            job = claim_next_job(worker_id)
+        except Exception as e:
+            logger.error(f"Worker {worker_id} claim error: {e}")
+            job = None
+
+        if not job:
+            stop_event.wait(JOB_POLL_INTERVAL)
+            continue
+
+        run_job(job, handler, on_failure)
+
+    # Ответы клиентам уходят в фоне — дожидаемся их перед выходом
+    stop_dispatcher()
+    # Остановился штатно — не пропал: отметку убираем
+    try:
+        with Session(engine) as session:
+            session.execute(delete(WorkerHeartbeat).where(WorkerHeartbeat.worker_id == worker_id))
+            session.commit()
+    except Exception as e: logger.error(f"Worker {worker_id} heartbeat cleanup error: {e}")
+    logger.info(f"👷 Worker {worker_id} stopped")
+
+def start_worker_pool(handler, on_failure=None, num_workers=JOB_WORKERS, warmup=None):
+    """
+    Запускает пул процессов-воркеров.
+    handler(user_phone, media_url, media_type) — обработчик задачи, должен бросать исключение при сбое.
+    on_failure(user_phone) — вызывается, когда попытки закончились.
+    warmup() — вызывается в каждом воркере один раз перед первой задачей.
+    """
+    global _pool
+    if _pool or num_workers <= 0: return _pool
+
+    # spawn, а не fork: gRPC-клиент Vision и пул соединений БД не переживают fork
+    ctx = multiprocessing.get_context("spawn")
+    stop_event = ctx.Event()
+    processes = []
+    for i in range(num_workers):
+        # Не daemon: воркеру можно заводить свои дочерние процессы
+        p = ctx.Process(target=_worker_loop, args=(handler, on_failure, stop_event, warmup), name=f"job-worker-{i}")
+        p.start()
+        processes.append(p)
+
+    _pool = (stop_event, processes)
+    logger.info(f"🚀 Started {num_workers} job workers")
+    return _pool
+
+def worker_status():
+    """Воркеры этого процесса: сколько запущено и сколько живы (без обращения к БД)."""
+    if not _pool: return {"configured": 0, "alive": 0}
+    _, processes = _pool
+    return {"configured": len(processes), "alive": sum(1 for p in processes if p.is_alive())}
+
+def stop_worker_pool(timeout=30):
+    global _pool
+    if not _pool: return
+    stop_event, processes = _pool
+    stop_event.set()
+    for p in processes:
+        p.join(timeout)
+        if p.is_alive(): p.terminate()
+    _pool = None
@@ -0,0 +1,279 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import concurrent.futures
+import httpx
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ключи Twilio, номер отправителя и MESSAGING_TRANSPORT (twilio — настоящая отправка, stub — только лог)
+# читаются при создании диспетчера, а не при импорте: main импортирует модуль до load_dotenv()
+DEFAULT_WHATSAPP_FROM = "whatsapp:+14155238886"
+MESSAGING_STUB_LATENCY = float(os.getenv("MESSAGING_STUB_LATENCY", "0.05"))
+# Лимит Twilio на номер отправителя: сообщений в секунду и допустимый всплеск (общий на все процессы, через БД)
+TWILIO_RATE_PER_SECOND = float(os.getenv("TWILIO_RATE_PER_SECOND", "1"))
+TWILIO_BURST = int(os.getenv("TWILIO_BURST", "5"))
+MESSAGING_WORKERS = int(os.getenv("MESSAGING_WORKERS", "4"))
+MESSAGING_MAX_RETRIES = int(os.getenv("MESSAGING_MAX_RETRIES", "4"))
+MESSAGING_RETRY_BASE_SECONDS = float(os.getenv("MESSAGING_RETRY_BASE_SECONDS", "1"))
+# Больше 1600 символов Twilio не принимает
+MESSAGE_MAX_CHARS = 1600
+
+def split_message(text, limit=MESSAGE_MAX_CHARS):
+    """Длинный отчет -> части не длиннее limit, по границам строк (длинную строку режем как есть)."""
+    parts, current = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current: parts.append(current); current = ""
+            parts.append(line[:limit]); line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = candidate
+    if current or not parts: parts.append(current)
+    return parts
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity. acquire() ждет, пока токен появится."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def reserve_send_slot(sender, rate, burst, now=None):
+    """
+    Бронирует отправку с номера sender в общем расписании (таблица sendrate) и возвращает,
+    сколько секунд подождать. Одно атомарное UPDATE на сообщение, поэтому все процессы
+    и серверы делят один лимит: rate сообщений в секунду, всплеск до burst.
+    """
+    from sqlalchemy import update, case
+    from sqlalchemy.exc import IntegrityError
+    from sqlmodel import Session
+    from database import engine, SendRate
+
+    interval = 1 / rate
+    now = time.time() if now is None else now
+    reserve = (
+        update(SendRate).where(SendRate.sender == sender)
+        .values(next_at=case((SendRate.next_at > now, SendRate.next_at), else_=now) + interval)
+        .returning(SendRate.next_at)
+    )
+    with Session(engine) as session:
+        next_at = session.execute(reserve).scalar()
+        if next_at is None:
+            # Первое сообщение с номера: заводим строку (одновременную вставку другим процессом пропускаем)
+            session.rollback()
+            session.add(SendRate(sender=sender, next_at=now))
+            try: session.commit()
+            except IntegrityError: session.rollback()
+            next_at = session.execute(reserve).scalar()
+        session.commit()
+    # Начало нашего слота минус окно всплеска
+    return max(0.0, next_at - interval - now - (burst - 1) * interval)
+
+class SharedRateLimit:
+    """
+    Лимит отправки с номера через reserve_send_slot (общий на все процессы).
+    БД недоступна — ждем по локальному TokenBucket, чтобы не остановить отправку совсем.
+    """
+    def __init__(self, sender, rate, capacity):
+        self.sender = sender
+        self.rate = rate
+        self.capacity = capacity
+        self.fallback = TokenBucket(rate, capacity)
+
+    async def acquire(self):
+        try:
+            delay = await asyncio.to_thread(reserve_send_slot, self.sender, self.rate, self.capacity)
+        except Exception as e:
+            logger.error(f"Shared rate limit error, using local limit: {e}")
+            await self.fallback.acquire()
+            return
+        if delay > 0: await asyncio.sleep(delay)
+
+class TransientSendError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TwilioTransport:
+    """REST API Twilio через общий httpx.AsyncClient (keep-alive)."""
+    def __init__(self):
+        account_sid = os.getenv("TWILIO_ACCOUNT_SID")
+        if not account_sid: logger.error("❌ TWILIO_ACCOUNT_SID is missing!")
+        self.url = f"https://api.twilio.com/2010-04-01/Accounts/{account_sid}/Messages.json"
+        self.client = httpx.AsyncClient(
+            auth=(account_sid or "", os.getenv("TWILIO_AUTH_TOKEN") or ""),
+            timeout=httpx.Timeout(15, connect=5),
+            limits=httpx.Limits(max_connections=MESSAGING_WORKERS * 2, max_keepalive_connections=MESSAGING_WORKERS),
+        )
+
+    async def send(self, from_, to, body):
+        try:
+            response = await self.client.post(self.url, data={"From": from_, "To": to, "Body": body})
+        except httpx.TransportError as e:
+            raise TransientSendError(f"{type(e).__name__}: {e}")
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = response.headers.get("retry-after")
+            raise TransientSendError(f"HTTP {response.status_code}", float(retry_after) if retry_after and retry_after.isdigit() else None)
+        if response.status_code >= 400:
+            # Неверный номер, нет прав и т.п. — повтор не поможет
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+
+    async def close(self):
+        await self.client.aclose()
+
+class StubTransport:
+    """Имитирует Twilio: задержка и лог. Отправленное складывается в sent (для тестов)."""
+    def __init__(self, latency=MESSAGING_STUB_LATENCY):
+        self.latency = latency
+        self.sent = []
+
+    async def send(self, from_, to, body):
+        await asyncio.sleep(self.latency)
+        self.sent.append((time.monotonic(), to, body))
+        logger.info(f"📨 [stub] -> {to}: {body[:60]!r}")
+
+    async def close(self):
+        pass
+
+class Dispatcher:
+    """
+    Очередь исходящих сообщений в фоновом event loop (свой поток).
+    Сообщения одного получателя всегда идут через одну и ту же очередь-воркер,
+    поэтому части длинного отчета и сами отчеты приходят по порядку.
+    """
+    def __init__(self, transport, workers=MESSAGING_WORKERS):
+        self.transport = transport
+        self.workers = max(1, workers)
+        self.from_ = os.getenv("TWILIO_WHATSAPP_FROM", DEFAULT_WHATSAPP_FROM)
+        self.loop = asyncio.new_event_loop()
+        self.buckets = {}
+        self.queues = []
+        self.tasks = []
+        self.sent = 0
+        self.failed = 0
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,), name="messaging-loop", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.queues = [asyncio.Queue() for _ in range(self.workers)]
+        self.tasks = [self.loop.create_task(self._worker(queue)) for queue in self.queues]
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def _bucket(self, from_):
+        if from_ not in self.buckets:
+            self.buckets[from_] = SharedRateLimit(from_, TWILIO_RATE_PER_SECOND, TWILIO_BURST)
+        return self.buckets[from_]
+
+    async def _send_part(self, from_, to, body):
+        for attempt in range(MESSAGING_MAX_RETRIES + 1):
+            await self._bucket(from_).acquire()
+            try:
+                metrics.inc("lawbot_api_calls_total", api="twilio")
+                await self.transport.send(from_, to, body)
+                return True
+            except TransientSendError as e:
+                if attempt == MESSAGING_MAX_RETRIES:
+                    logger.error(f"Twilio error, giving up on {to}: {e}")
+                    return False
+                delay = e.retry_after or MESSAGING_RETRY_BASE_SECONDS * (2 ** attempt) + random.uniform(0, 0.5)
+                logger.warning(f"Twilio {e}, retry {attempt + 1}/{MESSAGING_MAX_RETRIES} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                logger.error(f"Twilio error: {e}")
+                return False
+
+    async def _worker(self, queue):
+        while True:
+            from_, to, parts = await queue.get()
+            try:
+                for body in parts:
+                    if await self._send_part(from_, to, body): self.sent += 1
+                    else: self.failed += 1
+            finally:
+                queue.task_done()
+
+    def submit(self, to, body, from_=None):
+        """Потокобезопасно, не ждет отправки. from_ по умолчанию — TWILIO_WHATSAPP_FROM."""
+        from_ = from_ or self.from_
+        queue = self.queues[hash(to) % self.workers]
+        self.loop.call_soon_threadsafe(queue.put_nowait, (from_, to, split_message(body)))
+
+    async def _drain(self):
+        await asyncio.gather(*[queue.join() for queue in self.queues])
+
+    def flush(self, timeout=None):
+        """Ждет, пока очередь опустеет (например, перед остановкой процесса)."""
+        future = asyncio.run_coroutine_threadsafe(self._drain(), self.loop)
+        try: future.result(timeout)
+        except concurrent.futures.TimeoutError: future.cancel()
+
+    async def _shutdown(self):
+        for task in self.tasks: task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.transport.close()
+        await self.loop.shutdown_default_executor()  # потоки asyncio.to_thread (лимит через БД)
+
+    def stop(self, timeout=10):
+        """Дожидается очереди, гасит воркеры и закрывает loop: при выходе процесса не остается висящих задач."""
+        self.flush(timeout)
+        try: asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout)
+        except Exception as e: logger.error(f"Dispatcher shutdown error: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        if not self.thread.is_alive(): self.loop.close()
+
+    def stats(self):
+        return {"sent": self.sent, "failed": self.failed, "queued": sum(q.qsize() for q in self.queues)}
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def build_transport(name=None):
+    name = (name or os.getenv("MESSAGING_TRANSPORT", "twilio")).lower()
+    if name == "stub": return StubTransport()
+    return TwilioTransport()
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = Dispatcher(build_transport())
+    return _dispatcher
+
+def send_message(to_number, body_text):
+    """Ставит сообщение в очередь отправки и сразу возвращается (можно звать из async-кода)."""
+    to = f"whatsapp:{to_number}" if not to_number.startswith("whatsapp:") else to_number
+    get_dispatcher().submit(to, body_text)
+
+def stop_dispatcher(timeout=10):
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is not None:
+            _dispatcher.stop(timeout)
+            _dispatcher = None
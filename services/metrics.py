@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import glob
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Каждый процесс (веб, воркеры очереди) копит метрики у себя и сбрасывает снимок
+# в METRICS_DIR/<host>-<pid>.json; /metrics складывает снимки всех процессов
+# (в том числе других контейнеров, если temp_files общий).
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join("temp_files", "metrics"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "10"))
+
+# Границы гистограмм, секунды (от одной страницы OCR до целого PDF)
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+HELP = {
+    "lawbot_stage_seconds": "Время этапа обработки",
+    "lawbot_queue_wait_seconds": "Ожидание задачи в очереди",
+    "lawbot_job_seconds": "Полное время задачи",
+    "lawbot_jobs_total": "Задачи по результату",
+    "lawbot_api_calls_total": "Вызовы внешних API",
+    "lawbot_api_bytes_total": "Байты, отправленные во внешние API / полученные из них",
+    "lawbot_api_tokens_total": "Токены OpenAI",
+    "lawbot_cache_total": "Обращения к кэшу результатов",
+    "lawbot_rule_classifier_total": "Страницы, классифицированные правилами без LLM",
+    "lawbot_pages_total": "Обработанные страницы",
+    "lawbot_queue_jobs": "Задачи в очереди по статусу",
+    "lawbot_client_init_seconds": "Создание клиента внешнего сервиса (первое обращение)",
+}
+
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [count по BUCKETS..., +Inf, sum]
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_last_flush = 0.0
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name, value=1, **labels):
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+    trace = _trace
+    if trace: trace.add_counter(name, value, labels)
+    _maybe_flush()
+
+def observe(name, seconds, **labels):
+    with _lock:
+        key = _key(name, labels)
+        hist = _histograms.get(key)
+        if hist is None: hist = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for n, bound in enumerate(BUCKETS):
+            if seconds <= bound: hist[n] += 1
+        hist[len(BUCKETS)] += 1
+        hist[-1] += seconds
+    _maybe_flush()
+
+@contextmanager
+def timer(stage, **labels):
+    """Время этапа -> гистограмма lawbot_stage_seconds{stage=...} и в трассу текущей задачи."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        observe("lawbot_stage_seconds", seconds, stage=stage, **labels)
+        trace = _trace
+        if trace: trace.add_stage(stage, seconds)
+
+# --- ТРАССА ЗАДАЧИ ---
+class Trace:
+    """
+    Сводка одной задачи: время по этапам (сумма по страницам) и счетчики.
+    Воркер очереди выполняет одну задачу за раз, поэтому трасса — одна на процесс,
+    и ее видят все потоки пула страниц.
+    """
+    def __init__(self, job_id=None, queue_wait=None):
+        self.job_id = job_id
+        self.queue_wait = queue_wait
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_counter(self, name, value, labels):
+        label = ",".join(f"{k}={v}" for k, v in sorted(labels.items()))
+        with self._lock:
+            key = f"{name}{{{label}}}" if label else name
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def to_record(self):
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "queue_wait_seconds": round(self.queue_wait, 3) if self.queue_wait is not None else None,
+                "total_seconds": round(self.elapsed(), 3),
+                "stages": json.dumps({k: round(v, 3) for k, v in self.stages.items()}),
+                "counters": json.dumps(self.counters, ensure_ascii=False),
+            }
+
+_trace = None
+
+def start_trace(job_id=None, queue_wait=None):
+    global _trace
+    _trace = Trace(job_id, queue_wait)
+    return _trace
+
+def current_trace():
+    return _trace
+
+def end_trace():
+    global _trace
+    trace, _trace = _trace, None
+    flush()
+    return trace
+
+# --- СНИМКИ И PROMETHEUS ---
+def _snapshot():
+    with _lock:
+        return {
+            "counters": [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            "histograms": [[name, list(labels), list(hist)] for (name, labels), hist in _histograms.items()],
+        }
+
+def flush():
+    """Снимок метрик процесса на диск (атомарно: запись во временный файл и rename)."""
+    global _last_flush
+    with _flush_lock:
+        _last_flush = time.monotonic()
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            path = process_file(METRICS_DIR)
+            with open(path + ".tmp", "w") as f: json.dump(_snapshot(), f)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            logger.error(f"Metrics flush error: {e}")
+
+def _maybe_flush():
+    if time.monotonic() - _last_flush >= METRICS_FLUSH_SECONDS: flush()
+
+def process_file(directory):
+    return os.path.join(directory, f"{socket.gethostname()}-{os.getpid()}.json")
+
+def _is_dead(path):
+    """Снимок процесса этого хоста, которого уже нет. Про процессы других хостов судить не можем."""
+    host, _, pid = os.path.basename(path)[:-len(".json")].rpartition("-")
+    if not host: return True  # формат <pid>.json — от версии до нескольких веб-воркеров
+    if host != socket.gethostname() or not pid.isdigit(): return False
+    try: os.kill(int(pid), 0)
+    except ProcessLookupError: return True
+    except PermissionError: pass
+    return False
+
+def remove_dead(directory):
+    """
+    При старте процесса: снимки завершившихся процессов больше не нужны.
+    Живые (соседние веб-воркеры gunicorn, воркеры очереди) не трогаем.
+    """
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        if not _is_dead(path): continue
+        try: os.remove(path)
+        except OSError: pass
+
+def reset_snapshots():
+    remove_dead(METRICS_DIR)
+
+def _merged():
+    counters, histograms = {}, {}
+    snapshots = []
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        if path == process_file(METRICS_DIR): continue
+        try:
+            with open(path) as f: snapshots.append(json.load(f))
+        except (OSError, ValueError): continue
+    snapshots.append(_snapshot())  # текущий процесс — живые значения, а не файл
+
+    for snap in snapshots:
+        for name, labels, value in snap["counters"]:
+            key = (name, tuple(tuple(l) for l in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, hist in snap["histograms"]:
+            key = (name, tuple(tuple(l) for l in labels))
+            total = histograms.setdefault(key, [0] * len(hist))
+            for n, v in enumerate(hist): total[n] += v
+    return counters, histograms
+
+def _labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items: return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+def render_prometheus(gauges=None):
+    """Текстовый формат Prometheus по всем процессам. gauges: {"имя": {(("label", "v"),): значение}}."""
+    counters, histograms = _merged()
+    lines = []
+    typed = set()
+
+    def header(name, kind):
+        if name in typed: return
+        typed.add(name)
+        if name in HELP: lines.append(f"# HELP {name} {HELP[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {value}")
+
+    for (name, labels), hist in sorted(histograms.items()):
+        header(name, "histogram")
+        # Снимки хранят число попаданий в каждый интервал с накоплением (как le в Prometheus)
+        for bound, count in zip(BUCKETS, hist):
+            lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {count}")
+        lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {hist[len(BUCKETS)]}")
+        lines.append(f"{name}_sum{_labels(labels)} {hist[-1]:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {hist[len(BUCKETS)]}")
+
+    for name, values in (gauges or {}).items():
+        header(name, "gauge")
+        for labels, value in values.items():
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
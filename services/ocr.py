@@ -1,11 +1,16 @@
 import base64
 import os
 import fitz  # Это PyMuPDF
-from openai import OpenAI
 from dotenv import load_dotenv
+from services.health import LazyClient
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+def _openai_client():
+    from openai import OpenAI
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+client = LazyClient("openai_sync", _openai_client)
 
 def encode_image(image_bytes):
     return base64.b64encode(image_bytes).decode('utf-8')
@@ -51,7 +56,7 @@ def analyze_document_with_ai(file_bytes, filename):
     Если документ нечитаемый, верни "doc_type": "unknown".
     """
 
-    response = client.chat.completions.create(
+    response = client.get().chat.completions.create(
         model="gpt-4o",
         messages=[
             {
@@ -0,0 +1,214 @@
+import io
+import os
+import math
+import time
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from services import metrics
+from services.health import LazyClient
+
+logger = logging.getLogger(__name__)
+
+# vision / tesseract / auto (Vision, при сбоях и тормозах — Tesseract)
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto").lower()
+TESSERACT_LANG = os.getenv("TESSERACT_LANG", "rus+heb+eng")
+TESSERACT_PROCESSES = int(os.getenv("TESSERACT_PROCESSES", str(os.cpu_count() or 2)))
+# Когда переключаться на запасной движок
+OCR_FALLBACK_WINDOW = int(os.getenv("OCR_FALLBACK_WINDOW", "20"))
+OCR_FALLBACK_ERROR_RATE = float(os.getenv("OCR_FALLBACK_ERROR_RATE", "0.5"))
+OCR_FALLBACK_LATENCY_SECONDS = float(os.getenv("OCR_FALLBACK_LATENCY_SECONDS", "15"))
+OCR_FALLBACK_COOLDOWN_SECONDS = float(os.getenv("OCR_FALLBACK_COOLDOWN_SECONDS", "120"))
+
+# Все движки возвращают одинаковый результат:
+# {
+#     "text": "весь текст",
+#     "rotation": 0 / 90 / -90 / 180,   # угол для pil_image.rotate(..., expand=True), чтобы выпрямить страницу
+#     "blocks": [{"points": [(x, y), ...], "text": "текст блока"}, ...]  # координаты в исходной картинке
+# }
+
+def rotate_point(x, y, rotation, size):
+    """Куда попадает точка (x, y) картинки size=(w, h) после pil_image.rotate(rotation, expand=True)."""
+    w, h = size
+    if rotation == 90: return y, w - x
+    if rotation == -90: return h - y, x
+    if rotation in (180, -180): return w - x, h - y
+    return x, y
+
+def rotated_size(size, rotation):
+    w, h = size
+    return (h, w) if rotation in (90, -90) else (w, h)
+
+# --- GOOGLE VISION ---
+def _vision_client():
+    # google.cloud.vision тянет gRPC — импортируем только когда OCR действительно нужен
+    from google.cloud import vision
+    return vision, vision.ImageAnnotatorClient()
+
+class VisionOcrEngine:
+    name = "vision"
+
+    def __init__(self):
+        # Клиент (и проверка ключа) — при первой странице, а не при создании DocumentProcessor
+        self._client = LazyClient("vision", _vision_client)
+
+    def _detect_rotation(self, annotation):
+        """Угол по первому слову: 0 / 90 / -90 / 180."""
+        if not annotation.pages or not annotation.pages[0].blocks: return 0
+        word = annotation.pages[0].blocks[0].paragraphs[0].words[0]
+        v = word.bounding_box.vertices
+        dx = v[1].x - v[0].x
+        dy = v[1].y - v[0].y
+        rotation_angle = math.degrees(math.atan2(dy, dx))
+
+        if 45 <= rotation_angle < 135: return 90
+        if -135 < rotation_angle <= -45: return -90
+        if rotation_angle >= 135 or rotation_angle <= -135: return 180
+        return 0
+
+    def _block_text(self, block):
+        lines = []
+        for paragraph in block.paragraphs:
+            lines.append(" ".join("".join(s.text for s in word.symbols) for word in paragraph.words))
+        return "\n".join(lines)
+
+    def recognize(self, jpeg_bytes, size):
+        metrics.inc("lawbot_api_calls_total", api="vision")
+        metrics.inc("lawbot_api_bytes_total", len(jpeg_bytes), api="vision", direction="out")
+        vision, client = self._client.get()
+        response = client.document_text_detection(image=vision.Image(content=jpeg_bytes))
+        if response.error.message:
+            raise RuntimeError(f"Google Error: {response.error.message}")
+
+        annotation = response.full_text_annotation
+        if not annotation or not annotation.text:
+            return {"text": "", "rotation": 0, "blocks": []}
+
+        blocks = []
+        for page in annotation.pages:
+            for block in page.blocks:
+                blocks.append({
+                    "points": [(p.x, p.y) for p in block.bounding_box.vertices],
+                    "text": self._block_text(block),
+                })
+        return {"text": annotation.text, "rotation": self._detect_rotation(annotation), "blocks": blocks}
+
+# --- TESSERACT (локально, уже установлен в Docker-образе) ---
+def _tesseract_recognize(jpeg_bytes, lang):
+    """Выполняется в отдельном процессе пула."""
+    import pytesseract
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(jpeg_bytes))
+    size = img.size
+
+    # OSD: на сколько градусов по часовой надо повернуть страницу
+    rotation = 0
+    try:
+        osd = pytesseract.image_to_osd(img, output_type=pytesseract.Output.DICT)
+        rotation = {90: -90, 180: 180, 270: 90}.get(int(osd.get("rotate", 0)), 0)
+    except pytesseract.TesseractError:
+        pass  # мало текста для определения ориентации
+    if rotation:
+        img = img.rotate(rotation, expand=True)
+
+    data = pytesseract.image_to_data(img, lang=lang, output_type=pytesseract.Output.DICT)
+
+    # Собираем слова в блоки (как block у Vision)
+    grouped = {}
+    for i, word in enumerate(data["text"]):
+        word = (word or "").strip()
+        if not word or float(data["conf"][i]) < 0: continue
+        block = grouped.setdefault(data["block_num"][i], {"lines": {}, "box": [math.inf, math.inf, 0, 0]})
+        block["lines"].setdefault((data["par_num"][i], data["line_num"][i]), []).append(word)
+        x, y, w, h = data["left"][i], data["top"][i], data["width"][i], data["height"][i]
+        box = block["box"]
+        box[0], box[1] = min(box[0], x), min(box[1], y)
+        box[2], box[3] = max(box[2], x + w), max(box[3], y + h)
+
+    # Координаты возвращаем в системе исходной (неповернутой) картинки
+    inverse_size = rotated_size(size, rotation)
+    blocks = []
+    for num in sorted(grouped):
+        block = grouped[num]
+        x0, y0, x1, y1 = block["box"]
+        points = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+        if rotation:
+            points = [rotate_point(x, y, -rotation, inverse_size) for x, y in points]
+        text = "\n".join(" ".join(words) for _, words in sorted(block["lines"].items()))
+        blocks.append({"points": points, "text": text})
+
+    return {"text": "\n".join(b["text"] for b in blocks), "rotation": rotation, "blocks": blocks}
+
+class TesseractOcrEngine:
+    name = "tesseract"
+
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    @classmethod
+    def _get_pool(cls):
+        # Tesseract грузит CPU, поэтому отдельные процессы, а не потоки
+        if cls._pool is None:
+            with cls._pool_lock:
+                if cls._pool is None:
+                    cls._pool = ProcessPoolExecutor(
+                        max_workers=TESSERACT_PROCESSES,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+        return cls._pool
+
+    def recognize(self, jpeg_bytes, size):
+        return self._get_pool().submit(_tesseract_recognize, jpeg_bytes, TESSERACT_LANG).result()
+
+# --- АВТОПЕРЕКЛЮЧЕНИЕ ---
+class FallbackOcrEngine:
+    """
+    Основной движок, пока он здоров. Если в последних OCR_FALLBACK_WINDOW запросах
+    много ошибок или средняя задержка выше порога — на OCR_FALLBACK_COOLDOWN_SECONDS
+    переходим на запасной. Ошибка основного на конкретной странице тоже уходит в запасной.
+    """
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = f"{primary.name}+{fallback.name}"
+        self._history = deque(maxlen=OCR_FALLBACK_WINDOW)  # (ok, seconds)
+        self._tripped_until = 0
+        self._lock = threading.Lock()
+
+    def _record(self, ok, seconds):
+        with self._lock:
+            self._history.append((ok, seconds))
+            if len(self._history) < self._history.maxlen // 2: return
+            errors = sum(1 for ok_, _ in self._history if not ok_)
+            avg_latency = sum(s for _, s in self._history) / len(self._history)
+            if errors / len(self._history) >= OCR_FALLBACK_ERROR_RATE or avg_latency >= OCR_FALLBACK_LATENCY_SECONDS:
+                self._tripped_until = time.monotonic() + OCR_FALLBACK_COOLDOWN_SECONDS
+                self._history.clear()
+                logger.warning(f"⚠️ OCR: {self.primary.name} unhealthy (errors {errors}, avg {avg_latency:.1f}s), "
+                               f"switching to {self.fallback.name} for {OCR_FALLBACK_COOLDOWN_SECONDS:.0f}s")
+
+    def recognize(self, jpeg_bytes, size):
+        if time.monotonic() < self._tripped_until:
+            return self.fallback.recognize(jpeg_bytes, size)
+
+        started = time.monotonic()
+        try:
+            result = self.primary.recognize(jpeg_bytes, size)
+            self._record(True, time.monotonic() - started)
+            return result
+        except Exception as e:
+            self._record(False, time.monotonic() - started)
+            logger.error(f"OCR {self.primary.name} error, using {self.fallback.name}: {e}")
+            return self.fallback.recognize(jpeg_bytes, size)
+
+def build_ocr_engine(backend=OCR_BACKEND):
+    if backend == "tesseract":
+        return TesseractOcrEngine()
+    if backend == "vision":
+        return VisionOcrEngine()
+    # Нет ключа Google — Vision падает при первом запросе, страницы уходят в Tesseract,
+    # а после OCR_FALLBACK_WINDOW ошибок переключение держится весь cooldown
+    return FallbackOcrEngine(VisionOcrEngine(), TesseractOcrEngine())
@@ -1,55 +1,184 @@
 import os
 import json
+import random
+import asyncio
 import logging
-from openai import OpenAI
+import threading
+from services import metrics
+from services.health import LazyClient
+from openai import AsyncOpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
 
 logger = logging.getLogger(__name__)
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Ограничения и повторы
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_RETRY_BASE_SECONDS = float(os.getenv("OPENAI_RETRY_BASE_SECONDS", "1"))
+# Сколько символов OCR-текста влезает в один пакетный запрос (несколько страниц за раз)
+OPENAI_BATCH_MAX_CHARS = int(os.getenv("OPENAI_BATCH_MAX_CHARS", "12000"))
+PAGE_TEXT_LIMIT = 3000
+
+VISION_MODEL = "gpt-4o"
+TEXT_MODEL = "gpt-4o-mini"  # Дешево и быстро для текста
+
+# Все запросы идут через один event loop в фоновом потоке:
+# общий пул соединений, общий семафор на процесс, а вызывать можно из обычных потоков.
+_loop = None
+_semaphore = None
+_loop_lock = threading.Lock()
+# Без OPENAI_API_KEY падает только классификация, а не импорт и не старт процесса
+_client = LazyClient("openai", lambda: AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), timeout=OPENAI_TIMEOUT, max_retries=0))
+
+def _get_loop():
+    global _loop, _semaphore
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="openai-loop", daemon=True).start()
+                _semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+                _loop = loop
+    return _loop
+
+def _run(coro):
+    """Выполняет корутину в фоновом loop и ждет результат (для синхронного кода)."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+def _retry_delay(error, attempt):
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try: return float(retry_after)
+        except ValueError: pass
+    return OPENAI_RETRY_BASE_SECONDS * (2 ** attempt) + random.uniform(0, 0.5)
+
+async def _chat_json(model, messages, max_tokens=300):
+    """Один запрос с JSON-ответом. Повторяет на 429 / 5xx / таймаутах с экспоненциальной задержкой."""
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        try:
+            metrics.inc("lawbot_api_calls_total", api="openai", model=model)
+            async with _semaphore:
+                response = await _client.get().chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    response_format={"type": "json_object"} # Форсируем JSON
+                )
+            content = response.choices[0].message.content
+            if response.usage:
+                metrics.inc("lawbot_api_tokens_total", response.usage.prompt_tokens, model=model, kind="prompt")
+                metrics.inc("lawbot_api_tokens_total", response.usage.completion_tokens, model=model, kind="completion")
+            logger.info(f"🤖 RAW AI RESPONSE: {content}")
+            return json.loads(content)
+        except (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError) as e:
+            # Закончились деньги — повтор не поможет
+            if getattr(e, "code", None) == "insufficient_quota" or attempt == OPENAI_MAX_RETRIES: raise
+            delay = _retry_delay(e, attempt)
+            logger.warning(f"OpenAI {type(e).__name__}, retry {attempt + 1}/{OPENAI_MAX_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+def _build_messages(image_base64, prompt_text):
+    if image_base64:
+        # Режим Vision (Картинка + Текст)
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt_text},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}
+                    },
+                ],
+            }
+        ]
+        return VISION_MODEL, messages
+
+    # Режим Текст (Только промпт)
+    messages = [
+        {"role": "system", "content": "You are a helpful JSON parser."},
+        {"role": "user", "content": prompt_text}
+    ]
+    return TEXT_MODEL, messages
+
+async def analyze_document_async(image_base64, prompt_text):
+    try:
+        model, messages = _build_messages(image_base64, prompt_text)
+        metrics.inc("lawbot_api_bytes_total", len(prompt_text) + len(image_base64 or ""), api="openai", direction="out")
+        return await _chat_json(model, messages)
+    except Exception as e:
+        logger.error(f"OpenAI Error: {e}")
+        return None
+
+async def _classify_batch_async(texts):
+    pages = "\n\n".join(f"=== PAGE {n} ===\n{text[:PAGE_TEXT_LIMIT]}" for n, text in enumerate(texts, start=1))
+    prompt = f"""
+    Analyze OCR text of {len(texts)} document pages from one upload.
+    For EACH page:
+    1. Type (Passport, ID, Marriage, Birth, etc.)
+    2. Name (Latin)
+    {pages}
+    JSON: {{"pages": [{{"page": 1, "doc_type": "...", "person_name": "..."}}]}}
+    """
+    try:
+        model, messages = _build_messages(None, prompt)
+        metrics.inc("lawbot_api_bytes_total", len(prompt), api="openai", direction="out")
+        data = await _chat_json(model, messages, max_tokens=100 + 60 * len(texts))
+    except Exception as e:
+        logger.error(f"OpenAI Batch Error: {e}")
+        return [None] * len(texts)
+
+    results = [None] * len(texts)
+    for item in (data or {}).get("pages", []):
+        try: n = int(item.get("page")) - 1
+        except (TypeError, ValueError): continue
+        if 0 <= n < len(texts) and item.get("doc_type"):
+            results[n] = {"doc_type": item["doc_type"], "person_name": item.get("person_name", "Unknown")}
+    return results
+
+def _split_batches(texts):
+    """Группы соседних страниц, каждая не длиннее OPENAI_BATCH_MAX_CHARS."""
+    batches, current, size = [], [], 0
+    for n, text in enumerate(texts):
+        length = min(len(text), PAGE_TEXT_LIMIT)
+        if current and size + length > OPENAI_BATCH_MAX_CHARS:
+            batches.append(current)
+            current, size = [], 0
+        current.append(n)
+        size += length
+    if current: batches.append(current)
+    return batches
+
+async def _classify_pages_async(texts):
+    batches = _split_batches(texts)
+    answers = await asyncio.gather(*[_classify_batch_async([texts[n] for n in batch]) for batch in batches])
+    results = [None] * len(texts)
+    for batch, answer in zip(batches, answers):
+        for n, res in zip(batch, answer):
+            results[n] = res
+    return results
+
+async def _analyze_many_async(requests):
+    return await asyncio.gather(*[analyze_document_async(image, prompt) for image, prompt in requests])
 
 def analyze_document(image_base64, prompt_text):
     """
     Если image_base64 передан -> используем Vision (GPT-4o).
     Если image_base64 is None -> используем Text (GPT-4o-mini), это дешевле и нет цензуры на картинки.
     """
-    try:
-        messages = []
-        
-        if image_base64:
-            # Режим Vision (Картинка + Текст)
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt_text},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}
-                        },
-                    ],
-                }
-            ]
-            model = "gpt-4o"
-        else:
-            # Режим Текст (Только промпт)
-            messages = [
-                {"role": "system", "content": "You are a helpful JSON parser."},
-                {"role": "user", "content": prompt_text}
-            ]
-            model = "gpt-4o-mini" # Дешево и быстро для текста
-
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=300,
-            response_format={"type": "json_object"} # Форсируем JSON
-        )
-
-        content = response.choices[0].message.content
-        logger.info(f"🤖 RAW AI RESPONSE: {content}")
-
-        return json.loads(content)
+    return _run(analyze_document_async(image_base64, prompt_text))
 
-    except Exception as e:
-        logger.error(f"OpenAI Error: {e}")
-        return None
\ No newline at end of file
+def analyze_documents(requests):
+    """Несколько запросов [(image_base64, prompt_text), ...] параллельно (не больше OPENAI_MAX_CONCURRENCY)."""
+    if not requests: return []
+    return _run(_analyze_many_async(requests))
+
+def classify_pages(texts):
+    """
+    Классификация нескольких страниц по OCR-тексту одним запросом (или несколькими,
+    если текст не влезает в OPENAI_BATCH_MAX_CHARS). Возвращает список в порядке страниц:
+    {"doc_type", "person_name"} или None для страниц, по которым ответа нет.
+    """
+    if not texts: return []
+    return _run(_classify_pages_async(texts))
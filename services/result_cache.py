@@ -0,0 +1,93 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import delete
+from sqlmodel import Session, select
+from database import engine, ResultCache
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_TTL_DAYS = float(os.getenv("RESULT_CACHE_TTL_DAYS", "30"))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "50000"))
+# Чистка запускается раз в N записей, а не на каждую
+_EVICT_EVERY = 200
+
+_puts = 0
+_puts_lock = threading.Lock()
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def bytes_sha256(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, (bytes, memoryview)) else str(part).encode("utf-8"))
+    return h.hexdigest()
+
+def cache_get(kind, key):
+    """Возвращает сохраненный dict или None. Просроченные записи не отдаются."""
+    if not RESULT_CACHE_ENABLED: return None
+    try:
+        with Session(engine) as session:
+            entry = session.get(ResultCache, f"{kind}:{key}")
+            if not entry:
+                metrics.inc("lawbot_cache_total", kind=kind, result="miss")
+                return None
+            now = datetime.now()
+            if entry.created_at < now - timedelta(days=RESULT_CACHE_TTL_DAYS):
+                session.delete(entry)
+                session.commit()
+                metrics.inc("lawbot_cache_total", kind=kind, result="miss")
+                return None
+            entry.hits += 1
+            entry.last_used_at = now
+            session.add(entry)
+            session.commit()
+            logger.info(f"♻️ Cache hit: {kind} {key[:12]}")
+            metrics.inc("lawbot_cache_total", kind=kind, result="hit")
+            return json.loads(entry.payload)
+    except Exception as e:
+        logger.error(f"Cache read error: {e}")
+        return None
+
+def cache_put(kind, key, payload):
+    global _puts
+    if not RESULT_CACHE_ENABLED: return
+    try:
+        with Session(engine) as session:
+            cache_key = f"{kind}:{key}"
+            entry = session.get(ResultCache, cache_key) or ResultCache(key=cache_key, kind=kind, payload="")
+            entry.payload = json.dumps(payload, ensure_ascii=False)
+            entry.created_at = entry.last_used_at = datetime.now()
+            session.add(entry)
+            session.commit()
+    except Exception as e:
+        logger.error(f"Cache write error: {e}")
+        return
+
+    with _puts_lock:
+        _puts += 1
+        run_eviction = _puts % _EVICT_EVERY == 0
+    if run_eviction: evict()
+
+def evict():
+    """TTL: удаляем старые записи. LRU: если записей больше лимита — самые давно не использованные."""
+    try:
+        with Session(engine) as session:
+            expired_before = datetime.now() - timedelta(days=RESULT_CACHE_TTL_DAYS)
+            session.execute(delete(ResultCache).where(ResultCache.created_at < expired_before))
+
+            keep = select(ResultCache.key).order_by(ResultCache.last_used_at.desc()).limit(RESULT_CACHE_MAX_ENTRIES)
+            session.execute(delete(ResultCache).where(ResultCache.key.not_in(keep)))
+            session.commit()
+    except Exception as e:
+        logger.error(f"Cache eviction error: {e}")
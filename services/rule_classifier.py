@@ -0,0 +1,158 @@
+import os
+import re
+import logging
+from thefuzz import fuzz
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ниже этой уверенности страница уходит в LLM
+RULE_CLASSIFIER_MIN_CONFIDENCE = float(os.getenv("RULE_CLASSIFIER_MIN_CONFIDENCE", "0.85"))
+# Нечеткое совпадение заголовков (OCR путает буквы): порог thefuzz partial_ratio
+RULE_FUZZY_THRESHOLD = 90
+
+STRONG = 0.9
+WEAK = 0.4
+
+# Типы — те же, что REQUIRED_DOCS в main.py. (паттерн, вес); текст сравнивается в верхнем регистре.
+RULES = {
+    "Passport": [
+        (r"\bPASSPORT\b", STRONG), (r"\bПАСПОРТ\b", 0.7), (r"דרכון", STRONG), (r"\bPASSEPORT\b", STRONG),
+    ],
+    "ID_Document": [
+        (r"IDENTITY CARD", STRONG), (r"תעודת זהות", STRONG), (r"УДОСТОВЕРЕНИЕ ЛИЧНОСТИ", STRONG),
+        (r"\bID CARD\b", 0.7),
+    ],
+    "Marriage_Certificate": [
+        (r"MARRIAGE CERTIFICATE|CERTIFICATE OF MARRIAGE", STRONG), (r"ЗАКЛЮЧЕНИИ БРАКА", STRONG),
+        (r"תעודת נישואין", STRONG), (r"\bMARRIAGE\b", WEAK),
+    ],
+    "Birth_Certificate": [
+        (r"BIRTH CERTIFICATE|CERTIFICATE OF BIRTH", STRONG), (r"СВИДЕТЕЛЬСТВО О РОЖДЕНИИ", STRONG),
+        (r"תעודת לידה", STRONG),
+    ],
+    "Police_Clearance": [
+        (r"POLICE CLEARANCE|NO CRIMINAL RECORD|CRIMINAL RECORD CERTIFICATE", STRONG),
+        (r"СУДИМОСТ", STRONG), (r"תעודת יושר|מרשם פלילי", STRONG),
+    ],
+    "Marital_Status_Doc": [
+        (r"MARITAL STATUS|CERTIFICATE OF NO IMPEDIMENT|SINGLE STATUS", STRONG),
+        (r"СЕМЕЙНОЕ ПОЛОЖЕНИЕ|ОТСУТСТВИИ ГОСУДАРСТВЕННОЙ РЕГИСТРАЦИИ", STRONG), (r"מצב משפחתי", STRONG),
+    ],
+    "Relationship_Letter": [
+        (r"RELATIONSHIP LETTER|OUR RELATIONSHIP", 0.7), (r"\bWE MET\b", WEAK),
+    ],
+    "Bank_Statement": [
+        (r"ACCOUNT STATEMENT|BANK STATEMENT|STATEMENT OF ACCOUNT", STRONG), (r"ВЫПИСКА ПО (СЧЕТУ|СЧЁТУ|КАРТЕ)", STRONG),
+        (r"דף חשבון|תנועות בחשבון", STRONG), (r"\bIBAN\b", WEAK),
+        (r"LEUMI|HAPOALIM|DISCOUNT BANK|MIZRAHI|בנק לאומי|בנק הפועלים|СБЕРБАНК|ТИНЬКОФФ|АЛЬФА-БАНК|ВТБ", 0.6),
+    ],
+    "Salary_Slip": [
+        (r"PAYSLIP|PAY SLIP|SALARY SLIP|PAY STUB", STRONG), (r"РАСЧЕТНЫЙ ЛИСТОК|РАСЧЁТНЫЙ ЛИСТОК", STRONG),
+        (r"תלוש שכר|תלוש משכורת", STRONG), (r"\bGROSS SALARY\b|\bNET PAY\b", WEAK),
+    ],
+    "Rental_Contract": [
+        (r"LEASE AGREEMENT|RENTAL AGREEMENT|TENANCY AGREEMENT", STRONG), (r"ДОГОВОР (АРЕНДЫ|НАЙМА)", STRONG),
+        (r"הסכם שכירות|חוזה שכירות", STRONG), (r"\bLANDLORD\b|\bTENANT\b", WEAK),
+    ],
+    "Utility_Bill": [
+        (r"ELECTRICITY BILL|WATER BILL|GAS BILL|UTILITY BILL", STRONG), (r"חברת החשמל|ארנונה|תאגיד המים", STRONG),
+        (r"ЖКУ|ЖКХ|ЗА ЭЛЕКТРОЭНЕРГИЮ|КОММУНАЛЬН", STRONG),
+    ],
+    "Recommendation_Letter": [
+        (r"LETTER OF RECOMMENDATION|RECOMMENDATION LETTER|TO WHOM IT MAY CONCERN", 0.8),
+        (r"РЕКОМЕНДАТЕЛЬНОЕ ПИСЬМО|РЕКОМЕНДАЦИЯ", STRONG), (r"מכתב המלצה", STRONG),
+    ],
+}
+_COMPILED = {dtype: [(re.compile(p), w) for p, w in rules] for dtype, rules in RULES.items()}
+
+# Заголовки, которые ищем нечетко, если regex не сработал (OCR: "PASSP0RT", "BIRTH CERTIFlCATE")
+_FUZZY_TITLES = {
+    "Passport": ["PASSPORT"],
+    "Marriage_Certificate": ["MARRIAGE CERTIFICATE"],
+    "Birth_Certificate": ["BIRTH CERTIFICATE"],
+    "Police_Clearance": ["POLICE CLEARANCE"],
+    "Bank_Statement": ["ACCOUNT STATEMENT"],
+    "Salary_Slip": ["SALARY SLIP"],
+    "Rental_Contract": ["LEASE AGREEMENT", "RENTAL AGREEMENT"],
+}
+
+# Типы, которые почти всегда на имя самого клиента: имя можно взять из досье
+CLIENT_OWNED_TYPES = {"Bank_Statement", "Salary_Slip", "Rental_Contract", "Utility_Bill"}
+
+# MRZ: паспорт (TD3, строка 1) и ID-карта (TD1, строка 3)
+_MRZ_TD3 = re.compile(r"^P[A-Z<][A-Z<]{3}([A-Z<]{30,41})$")
+_MRZ_TD1_NAME = re.compile(r"^([A-Z]+(?:<[A-Z]+)*)<<([A-Z]+(?:<[A-Z]+)*)<*$")
+_MRZ_TD1_FIRST = re.compile(r"^[IAC][A-Z<][A-Z<]{3}[A-Z0-9<]{25}$")
+
+def _mrz_lines(text):
+    lines = []
+    for line in text.upper().splitlines():
+        line = line.replace(" ", "").replace("«", "<").replace("‹", "<")
+        if line.count("<") >= 3 and len(line) >= 28: lines.append(line)
+    return lines
+
+def _format_name(surname, given):
+    parts = given.replace("<", " ").split() + surname.replace("<", " ").split()
+    return " ".join(p.capitalize() for p in parts)
+
+def parse_mrz(text):
+    """
+    Ищет машиночитаемую зону. Возвращает {"doc_type", "person_name"} или None.
+    """
+    lines = _mrz_lines(text)
+    for n, line in enumerate(lines):
+        m = _MRZ_TD3.match(line)
+        if m and "<<" in m.group(1):
+            surname, given = m.group(1).split("<<", 1)
+            if surname.strip("<"):
+                return {"doc_type": "Passport", "person_name": _format_name(surname, given)}
+
+        if _MRZ_TD1_FIRST.match(line) and n + 2 < len(lines):
+            m = _MRZ_TD1_NAME.match(lines[n + 2])
+            if m:
+                return {"doc_type": "ID_Document", "person_name": _format_name(m.group(1), m.group(2))}
+    return None
+
+def score_types(text):
+    """Уверенность 0..1 по каждому типу: 1 - П(1 - вес) по совпавшим правилам."""
+    upper = text.upper()
+    scores = {}
+    for dtype, rules in _COMPILED.items():
+        miss = 1.0
+        for pattern, weight in rules:
+            if pattern.search(upper): miss *= (1 - weight)
+        if miss == 1.0:
+            for title in _FUZZY_TITLES.get(dtype, []):
+                if fuzz.partial_ratio(title, upper) >= RULE_FUZZY_THRESHOLD:
+                    miss *= (1 - STRONG * 0.9)
+                    break
+        if miss < 1.0: scores[dtype] = 1 - miss
+    return scores
+
+def classify_text(text, known_person=None):
+    """
+    Локальная классификация по OCR-тексту.
+    Возвращает {"doc_type", "person_name", "confidence"} или None, если уверенности мало —
+    тогда страницу классифицирует LLM.
+    """
+    result = None
+    mrz = parse_mrz(text or "")
+    if mrz:
+        result = dict(mrz, confidence=0.99)
+    elif text:
+        scores = score_types(text)
+        if scores:
+            ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+            dtype, confidence = ranked[0]
+            # Два типа почти равны — это не уверенность
+            if len(ranked) > 1 and confidence - ranked[1][1] < 0.2:
+                confidence -= 0.2
+            # Без имени классификация неполная: имя клиента подходит только для его собственных документов
+            if confidence >= RULE_CLASSIFIER_MIN_CONFIDENCE and known_person and dtype in CLIENT_OWNED_TYPES:
+                result = {"doc_type": dtype, "person_name": known_person, "confidence": round(confidence, 2)}
+
+    metrics.inc("lawbot_rule_classifier_total", result="hit" if result else "miss")
+    if result:
+        logger.info(f"🧮 Rules: {result['doc_type']} ({result['confidence']:.0%}), LLM skipped")
+    return result
@@ -1,9 +1,16 @@
 import os
+import time
+import contextlib
 import logging
+import threading
 import yadisk
 import dropbox
-from dropbox.files import WriteMode
+from yadisk.exceptions import ParentNotFoundError, PathExistsError, PathNotFoundError
+from dropbox.files import WriteMode, CommitInfo, UploadSessionCursor
 from dropbox.exceptions import ApiError
+from services.http_client import HTTP_POOL_SIZE
+from services import metrics
+from services.health import LazyClient
 
 logger = logging.getLogger(__name__)
 
@@ -11,27 +18,71 @@ logger = logging.getLogger(__name__)
 PROVIDER = os.getenv("STORAGE_PROVIDER", "yandex").lower()
 YANDEX_TOKEN = os.getenv("YANDEX_DISK_TOKEN")
 DROPBOX_TOKEN = os.getenv("DROPBOX_TOKEN")
+# Сколько помним, что папка в облаке уже есть (папки клиентов не удаляются)
+STORAGE_FOLDER_CACHE_TTL = float(os.getenv("STORAGE_FOLDER_CACHE_TTL", "3600"))
+# Большие файлы грузятся кусками; кусок, на котором оборвалась связь, повторяется
+STORAGE_CHUNK_MB = int(os.getenv("STORAGE_CHUNK_MB", "8"))
+STORAGE_UPLOAD_RETRIES = int(os.getenv("STORAGE_UPLOAD_RETRIES", "3"))
+CHUNK_SIZE = STORAGE_CHUNK_MB * 1024 * 1024
+
+class FolderCache:
+    """Папки, которые точно существуют в облаке: путь -> (значение, срок годности). Общий на процесс."""
+    def __init__(self, ttl=STORAGE_FOLDER_CACHE_TTL):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            item = self._items.get(path)
+            if item and item[1] > time.monotonic(): return item[0]
+            self._items.pop(path, None)
+            return None
+
+    def add(self, path, value=True):
+        with self._lock:
+            self._items[path] = (value, time.monotonic() + self.ttl)
+
+_yandex_folders = FolderCache()
+
+# Клиенты создаются один раз на процесс: держат пул соединений (keep-alive) между загрузками
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _cached_client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.setdefault(name, LazyClient(name, factory))
+    return client.get()
 
 def _get_yandex_client():
     if not YANDEX_TOKEN:
         logger.error("❌ Yandex Token is missing!")
         return None
-    return yadisk.YaDisk(token=YANDEX_TOKEN)
+    return _cached_client("yandex", lambda: yadisk.YaDisk(token=YANDEX_TOKEN))
 
 def _get_dropbox_client():
     if not DROPBOX_TOKEN:
         logger.error("❌ Dropbox Token is missing!")
         return None
-    return dropbox.Dropbox(DROPBOX_TOKEN)
+    return _cached_client("dropbox", lambda: dropbox.Dropbox(
+        DROPBOX_TOKEN, session=dropbox.create_session(max_connections=HTTP_POOL_SIZE)
+    ))
 
 def upload_file_to_cloud(local_path, remote_path):
     """
     Универсальная функция загрузки.
+    local_path — путь к файлу или открытый бинарный файл-объект (BytesIO, SpooledTemporaryFile).
     """
-    if PROVIDER == "dropbox":
-        return _upload_to_dropbox(local_path, remote_path)
-    else:
-        return _upload_to_yandex(local_path, remote_path)
+    size = os.path.getsize(local_path) if isinstance(local_path, (str, os.PathLike)) else local_path.seek(0, os.SEEK_END)
+    metrics.inc("lawbot_api_calls_total", api=PROVIDER)
+    metrics.inc("lawbot_api_bytes_total", size, api=PROVIDER, direction="out")
+    with metrics.timer("upload", provider=PROVIDER):
+        if PROVIDER == "dropbox":
+            return _upload_to_dropbox(local_path, remote_path)
+        else:
+            return _upload_to_yandex(local_path, remote_path)
 
 def publish_file(remote_path):
     """
@@ -43,23 +94,42 @@ def publish_file(remote_path):
         return _publish_yandex(remote_path)
 
 # --- YANDEX LOGIC ---
+def _ensure_yandex_folder(y, folder_path, trust_cache=True):
+    """Создает недостающие папки пути сверху вниз. Известные по кэшу пропускаем без запросов."""
+    current_path = ""
+    for part in folder_path.strip("/").split("/"):
+        current_path += f"/{part}"
+        if trust_cache and _yandex_folders.get(current_path): continue
+        try: y.mkdir(current_path)
+        except PathExistsError: pass
+        _yandex_folders.add(current_path)
+
 def _upload_to_yandex(local_path, remote_path):
+    """
+    Сразу upload с перезаписью (запрос ссылки + PUT), без exists/remove.
+    Только если родительской папки нет — создаем путь, пропуская папки, известные по кэшу.
+    """
     y = _get_yandex_client()
     if not y: return False
+    folder_path = os.path.dirname(remote_path)
     try:
-        folder_path = os.path.dirname(remote_path)
-        parts = folder_path.strip("/").split("/")
-        current_path = ""
-        for part in parts:
-            current_path += f"/{part}"
-            if not y.exists(current_path):
-                try: y.mkdir(current_path)
-                except: pass
-
-        if y.exists(remote_path):
-            y.remove(remote_path)
-
-        y.upload(local_path, remote_path)
+        # Файл читается потоком. Докачки по смещению у API Яндекса нет,
+        # поэтому при обрыве yadisk повторяет загрузку целиком (n_retries)
+        def upload():
+            with _open_source(local_path) as f:
+                y.upload(f, remote_path, overwrite=True, n_retries=STORAGE_UPLOAD_RETRIES)
+        try:
+            upload()
+        except ParentNotFoundError:
+            try: _ensure_yandex_folder(y, folder_path)
+            except ParentNotFoundError:
+                # Кэш устарел (папку удалили вручную) — проходим путь целиком
+                _ensure_yandex_folder(y, folder_path, trust_cache=False)
+            upload()
+        # Файл лег — значит, весь путь существует
+        while folder_path not in ("", "/"):
+            _yandex_folders.add(folder_path)
+            folder_path = os.path.dirname(folder_path)
         logger.info(f"✅ Uploaded to Yandex: {remote_path}")
         return True
     except Exception as e:
@@ -70,27 +140,70 @@ def _publish_yandex(remote_path):
     y = _get_yandex_client()
     if not y: return None
     try:
-        if not y.exists(remote_path): return None
-        # Проверяем, может уже опубликовано
-        meta = y.get_meta(remote_path)
-        if meta.public_url:
-            return meta.public_url
-        
+        # publish для уже опубликованного файла ничего не меняет: 2 запроса вместо 4
         y.publish(remote_path)
-        meta = y.get_meta(remote_path)
-        return meta.public_url
+        return y.get_meta(remote_path, fields=["public_url"]).public_url
+    except PathNotFoundError:
+        return None
     except Exception as e:
         logger.error(f"Yandex Publish Error: {e}")
         return None
 
 # --- DROPBOX LOGIC ---
+def _with_retries(call, what):
+    for attempt in range(STORAGE_UPLOAD_RETRIES + 1):
+        try:
+            return call()
+        except ApiError:
+            raise  # ошибка API (нет места, плохой путь) — повтор не поможет
+        except Exception as e:
+            if attempt == STORAGE_UPLOAD_RETRIES: raise
+            logger.warning(f"{what} failed ({e}), retry {attempt + 1}/{STORAGE_UPLOAD_RETRIES}")
+            time.sleep(2 ** attempt)
+
+def _dropbox_upload_session(dbx, f, size, remote_path):
+    """
+    Upload session: кусками по CHUNK_SIZE, в памяти только текущий кусок.
+    При обрыве повторяется один кусок; если сервер уже принял его (incorrect_offset) —
+    продолжаем с того смещения, которое он назвал.
+    """
+    session_id = _with_retries(lambda: dbx.files_upload_session_start(f.read(CHUNK_SIZE)).session_id, "Dropbox session start")
+    cursor = UploadSessionCursor(session_id=session_id, offset=f.tell())
+    commit = CommitInfo(path=remote_path, mode=WriteMode('overwrite'))
+
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        last = f.tell() >= size
+        try:
+            if last:
+                return _with_retries(lambda: dbx.files_upload_session_finish(chunk, cursor, commit), "Dropbox session finish")
+            _with_retries(lambda: dbx.files_upload_session_append_v2(chunk, cursor), "Dropbox chunk")
+            cursor.offset = f.tell()
+        except ApiError as e:
+            lookup = e.error.get_lookup_failed() if e.error.is_lookup_failed() else None
+            if not (lookup and lookup.is_incorrect_offset()): raise
+            cursor.offset = lookup.get_incorrect_offset().correct_offset
+            f.seek(cursor.offset)
+
+def _open_source(source):
+    """Путь -> открытый файл; файл-объект отдаем как есть (закрывает его владелец)."""
+    if isinstance(source, (str, os.PathLike)): return open(source, 'rb')
+    source.seek(0)
+    return contextlib.nullcontext(source)
+
 def _upload_to_dropbox(local_path, remote_path):
     dbx = _get_dropbox_client()
     if not dbx: return False
     try:
         if not remote_path.startswith('/'): remote_path = '/' + remote_path
-        with open(local_path, 'rb') as f:
-            dbx.files_upload(f.read(), remote_path, mode=WriteMode('overwrite'))
+        with _open_source(local_path) as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(0)
+            if size <= CHUNK_SIZE:
+                data = f.read()
+                _with_retries(lambda: dbx.files_upload(data, remote_path, mode=WriteMode('overwrite')), "Dropbox upload")
+            else:
+                _dropbox_upload_session(dbx, f, size, remote_path)
         logger.info(f"✅ Uploaded to Dropbox: {remote_path}")
         return True
     except Exception as e:
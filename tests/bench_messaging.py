@@ -0,0 +1,55 @@
+"""
+Нагрузочный тест очереди исходящих сообщений без Twilio (StubTransport).
+
+    python tests/bench_messaging.py [сообщений] [получателей] [лимит/с]
+
+Показывает фактическую скорость отправки (должна упираться в общий лимит из таблицы sendrate),
+сколько вызов send_message держит вызывающий поток и порядок сообщений у каждого получателя.
+"""
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+# Добавляем корневую папку в путь, чтобы видеть services
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+if __name__ == "__main__":
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    recipients = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    os.environ["MESSAGING_TRANSPORT"] = "stub"
+    os.environ.setdefault("TWILIO_RATE_PER_SECOND", sys.argv[3] if len(sys.argv) > 3 else "50")
+    os.environ.setdefault("MESSAGING_STUB_LATENCY", "0.2")
+    # Лимит отправки живет в БД (таблица sendrate): своя временная база, рабочую не трогаем
+    db_dir = tempfile.mkdtemp(prefix="bench_messaging_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(db_dir, 'bench.db')}"
+    os.environ.setdefault("METRICS_DIR", os.path.join(db_dir, "metrics"))
+
+    from database import init_db
+    from services import messaging
+    init_db()
+
+    started = time.perf_counter()
+    submit_times = []
+    for i in range(total):
+        t = time.perf_counter()
+        messaging.send_message(f"+10000000{i % recipients:03d}", f"Сообщение {i}\n" + "строка отчета\n" * (i % 150))
+        submit_times.append(time.perf_counter() - t)
+
+    dispatcher = messaging.get_dispatcher()
+    dispatcher.flush()
+    elapsed = time.perf_counter() - started
+    sent = dispatcher.transport.sent
+
+    in_order = True
+    for n in range(recipients):
+        numbers = [int(body.split()[1]) for _, to, body in sent if to.endswith(f"{n:03d}") and body.startswith("Сообщение")]
+        in_order &= numbers == sorted(numbers)
+
+    print(f"\n📊 сообщений: {total}, частей отправлено: {len(sent)}, за {elapsed:.2f}s")
+    print(f"скорость: {len(sent) / elapsed:.1f}/s при лимите {messaging.TWILIO_RATE_PER_SECOND}/s")
+    print(f"send_message: max {max(submit_times) * 1000:.2f} мс")
+    print(f"порядок у получателей сохранен: {in_order}, статистика: {dispatcher.stats()}")
+    messaging.stop_dispatcher()
+    shutil.rmtree(db_dir, ignore_errors=True)
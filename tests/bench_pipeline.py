@@ -0,0 +1,376 @@
+"""
+Офлайн-бенчмарк всего пайплайна: без ключей и без сети.
+Google Vision, OpenAI, Яндекс.Диск/Dropbox и Twilio заменены локальными заглушками
+с записанными ответами и настраиваемой задержкой.
+
+    python tests/bench_pipeline.py [--corpus photo,scan,digital] [--files 5] [--storage yandex]
+                                   [--vision-ms 400] [--openai-ms 900] [--storage-ms 200]
+                                   [--twilio-ms 100] [--media-ms 150]
+                                   [--save baseline.json] [--baseline baseline.json] [--tolerance 0.2]
+
+Корпуса генерируются один раз в temp_files/bench/:
+  photo   — фото 4000x3000 (JPEG, паспорт с MRZ: классифицируется правилами, без LLM);
+  scan    — PDF из 6 растровых страниц A4 (выписка: OCR + LLM);
+  digital — PDF из 6 страниц с текстовым слоем (OCR не нужен).
+
+Для каждого корпуса два режима, каждый в отдельном процессе (честный пик памяти):
+  processor — DocumentProcessor.process_and_upload напрямую;
+  e2e       — POST /whatsapp -> очередь -> process_file_task -> ответ через StubTransport.
+
+Облако подменено на уровне клиента (yadisk.YaDisk / dropbox.Dropbox), так что код
+services/storage (папки, потоковая загрузка, публикация) выполняется как в проде.
+
+Отчет: страниц/с, p50/p95 времени на файл, пик RSS. Код выхода 1, если хоть одна страница
+не обработана или страниц не столько, сколько в корпусе (замер без результата ничего не стоит).
+С --baseline — еще и регрессионный гейт: страниц/с упало или p95 выросло больше чем на --tolerance.
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import multiprocessing
+# Добавляем корневую папку в путь, чтобы видеть services
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+
+BENCH_DIR = os.path.join("temp_files", "bench")
+PAGES_PER_PDF = 6
+
+# --- ЗАПИСАННЫЕ ОТВЕТЫ ---
+PHOTO_TEXT = (
+    "STATE OF ISRAEL\nPASSPORT\nSurname IVANOV\nGiven names IVAN\n"
+    "P<ISRIVANOV<<IVAN<<<<<<<<<<<<<<<<<<<<<<<<<<<\n12345678<0ISR8001012M3001017<<<<<<<<<<<<<<06"
+)
+SCAN_TEXT = (
+    "Statement period 01.01.2024 - 31.01.2024\nAccount 12-345-678901\n"
+    "01.01 Opening balance 10,250.00\n05.01 Salary transfer 8,400.00\n12.01 Card payment 312.40\n"
+    "20.01 Rent 4,500.00\n31.01 Closing balance 13,837.60\n"
+)
+DIGITAL_TEXT = (
+    "EMPLOYMENT CONFIRMATION\nTo whom it may concern. This letter confirms that the employee has been working "
+    "at our company since 2019 in the position of senior engineer with a monthly gross salary of 18,000 ILS."
+)
+LLM_ANSWER = {"doc_type": "Bank_Statement", "person_name": "Ivan Ivanov"}
+
+def _pages_per_file(corpus):
+    return 1 if corpus == "photo" else PAGES_PER_PDF
+
+def _make_corpus(name, count):
+    """Файлы корпуса (генерируются один раз и дальше переиспользуются)."""
+    import numpy as np
+    import cv2
+    import fitz
+    import img2pdf
+
+    folder = os.path.join(BENCH_DIR, name)
+    os.makedirs(folder, exist_ok=True)
+    ext = ".jpg" if name == "photo" else ".pdf"
+    paths = [os.path.join(folder, f"{name}_{n}{ext}") for n in range(count)]
+    rng = np.random.default_rng(0)
+
+    for n, path in enumerate(paths):
+        if os.path.exists(path): continue
+        if name == "photo":
+            arr = rng.integers(90, 200, size=(3000, 4000, 3), dtype=np.uint8)
+            for y in range(600, 2400, 70):
+                cv2.putText(arr, f"PASSPORT  ISRAEL  {n:07d}  IVANOV IVAN", (700, y), cv2.FONT_HERSHEY_SIMPLEX, 1.6, (20, 20, 20), 3)
+            cv2.imwrite(path, arr, [cv2.IMWRITE_JPEG_QUALITY, 92])
+        elif name == "scan":
+            pages = []
+            for p in range(PAGES_PER_PDF):
+                arr = np.full((2339, 1654, 3), 235, dtype=np.uint8)  # A4, 200 dpi
+                arr += rng.integers(0, 15, size=arr.shape, dtype=np.uint8)
+                for y in range(200, 2100, 55):
+                    cv2.putText(arr, f"{p + 1:02d}.01  Transfer  {n}-{y}  1,234.00", (150, y), cv2.FONT_HERSHEY_SIMPLEX, 1.1, (30, 30, 30), 2)
+                pages.append(cv2.imencode(".jpg", arr, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes())
+            with open(path, "wb") as f: f.write(img2pdf.convert(pages))
+        else:
+            doc = fitz.open()
+            for p in range(PAGES_PER_PDF):
+                page = doc.new_page()
+                page.insert_textbox(fitz.Rect(60, 60, 540, 780), f"{DIGITAL_TEXT}\nPage {p + 1}, file {n}\n" * 4, fontsize=11)
+            doc.save(path)
+            doc.close()
+    return paths
+
+# --- ЗАГЛУШКИ ВНЕШНИХ СЕРВИСОВ ---
+class FakeVisionEngine:
+    """Ответ Vision в формате services/ocr_engines: записанный текст, один блок по центру кадра."""
+    name = "fake-vision"
+
+    def __init__(self, text, latency):
+        self.text = text
+        self.latency = latency
+
+    def recognize(self, jpeg_bytes, size):
+        time.sleep(self.latency)
+        w, h = size
+        box = [(w * 0.1, h * 0.1), (w * 0.9, h * 0.1), (w * 0.9, h * 0.9), (w * 0.1, h * 0.9)]
+        return {"text": self.text, "rotation": 0, "blocks": [{"points": box, "text": self.text}]}
+
+class FakeYaDisk:
+    """
+    yadisk.YaDisk в памяти: папки, загрузка потоком, публикация.
+    Как настоящий API — ParentNotFoundError, если папки нет, PathExistsError на повторный mkdir.
+    """
+    def __init__(self, latency, token=None):
+        self.latency = latency
+        self.folders = {"/"}
+        self.files = {}
+
+    @staticmethod
+    def _norm(path):
+        return "/" + path.strip("/")
+
+    def mkdir(self, path):
+        from yadisk.exceptions import ParentNotFoundError, PathExistsError
+        path = self._norm(path)
+        if path in self.folders: raise PathExistsError()
+        if os.path.dirname(path) not in self.folders: raise ParentNotFoundError()
+        self.folders.add(path)
+
+    def upload(self, f, path, overwrite=False, n_retries=0):
+        from yadisk.exceptions import ParentNotFoundError
+        path = self._norm(path)
+        if os.path.dirname(path) not in self.folders: raise ParentNotFoundError()
+        size = 0
+        while chunk := f.read(1024 * 1024): size += len(chunk)
+        time.sleep(self.latency)
+        self.files[path] = size
+
+    def publish(self, path):
+        if self._norm(path) not in self.files:
+            from yadisk.exceptions import PathNotFoundError
+            raise PathNotFoundError()
+
+    def get_meta(self, path, fields=None):
+        from types import SimpleNamespace
+        return SimpleNamespace(public_url=f"https://disk.example{self._norm(path)}")
+
+class FakeDropbox:
+    """dropbox.Dropbox в памяти: простая загрузка, upload session, публичная ссылка."""
+    def __init__(self, latency, token=None, session=None):
+        self.latency = latency
+        self.files = {}
+        self.sessions = {}
+
+    def files_upload(self, data, path, mode=None):
+        time.sleep(self.latency)
+        self.files[path] = len(data)
+
+    def files_upload_session_start(self, data):
+        from types import SimpleNamespace
+        session_id = f"s{len(self.sessions)}"
+        self.sessions[session_id] = len(data)
+        return SimpleNamespace(session_id=session_id)
+
+    def files_upload_session_append_v2(self, data, cursor):
+        self.sessions[cursor.session_id] += len(data)
+
+    def files_upload_session_finish(self, data, cursor, commit):
+        time.sleep(self.latency)
+        self.files[commit.path] = self.sessions.pop(cursor.session_id) + len(data)
+
+    def sharing_create_shared_link_with_settings(self, path):
+        from types import SimpleNamespace
+        return SimpleNamespace(url=f"https://dropbox.example{path}")
+
+def _install_fakes(args, corpus):
+    """Подменяет внешние вызовы на уровне модулей и SDK-клиентов (до первого запроса)."""
+    from services import openai_client, storage
+
+    async def fake_chat_json(model, messages, max_tokens=300):
+        from services import metrics
+        metrics.inc("lawbot_api_calls_total", api="openai", model=model)
+        await asyncio.sleep(args.openai_ms / 1000)
+        prompt = json.dumps(messages, ensure_ascii=False)
+        pages = prompt.count("=== PAGE ")
+        if pages:
+            return {"pages": [dict(LLM_ANSWER, page=n) for n in range(1, pages + 1)]}
+        return dict(LLM_ANSWER)
+    openai_client._chat_json = fake_chat_json
+
+    # Подменяем сами классы SDK: фабрики в services/storage создают клиент как обычно
+    import yadisk
+    import dropbox
+    latency = args.storage_ms / 1000
+    yadisk.YaDisk = lambda token=None: FakeYaDisk(latency, token)
+    dropbox.Dropbox = lambda token=None, session=None: FakeDropbox(latency, token, session)
+    storage.PROVIDER = args.storage
+    storage.YANDEX_TOKEN = storage.DROPBOX_TOKEN = "bench"
+
+    text = {"photo": PHOTO_TEXT, "scan": SCAN_TEXT, "digital": DIGITAL_TEXT}[corpus]
+    return FakeVisionEngine(text, args.vision_ms / 1000)
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values: return 0.0
+    k = (len(values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def _run_processor(args, corpus, paths, engine):
+    from services.doc_processor import DocumentProcessor
+    processor = DocumentProcessor()
+    processor.ocr_engine = engine
+
+    latencies, pages, errors = [], 0, []
+    for n, path in enumerate(paths):
+        started = time.perf_counter()
+        results = processor.process_and_upload(f"BENCH{n}", path, os.path.basename(path))
+        latencies.append(time.perf_counter() - started)
+        pages += sum(1 for r in results if r.get("status") == "success")
+        errors += [f"{os.path.basename(path)}: {r.get('message')}" for r in results if r.get("status") != "success"]
+    return latencies, pages, errors
+
+def _run_e2e(args, corpus, paths, engine):
+    from fastapi.testclient import TestClient
+    import main
+    from services import job_queue, messaging
+
+    main.get_processor().ocr_engine = engine
+
+    # «Twilio» отдает медиа: копия файла корпуса с задержкой сети
+    def fake_download(url, dest_dir, name_prefix, media_type=None):
+        time.sleep(args.media_ms / 1000)
+        local_path = os.path.join(dest_dir, name_prefix + os.path.splitext(url)[1])
+        shutil.copyfile(url, local_path)
+        return local_path
+    main.download_media = fake_download
+
+    latencies, pages, webhook = [], 0, []
+    sent = messaging.get_dispatcher().transport.sent
+    already_sent = len(sent)  # ответы прогрева не считаем
+    with TestClient(main.app) as client:
+        for n, path in enumerate(paths):
+            phone = f"+1555000{n:04d}"
+            started = time.perf_counter()
+            response = client.post("/whatsapp", data={"From": f"whatsapp:{phone}", "MediaUrl0": path,
+                                                       "MediaContentType0": "application/pdf" if path.endswith(".pdf") else "image/jpeg"})
+            webhook.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.text
+
+            job = job_queue.claim_next_job("bench")
+            job_queue.run_job(job, main.process_file_task, main.notify_job_failed)
+            messaging.get_dispatcher().flush()
+            latencies.append(time.perf_counter() - started)
+
+    # Каждый файл должен закончиться ответом «Принято страниц»; все остальное — ошибка
+    replies = [body for _, _, body in sent[already_sent:]]
+    pages = sum(int(body.split("Принято страниц: ")[1].split()[0]) for body in replies if "Принято страниц" in body)
+    errors = [body.splitlines()[0] for body in replies if "Принято страниц" not in body]
+    if sum("Принято страниц" in body for body in replies) != len(paths):
+        errors.append(f"ответов о приеме: {sum('Принято страниц' in body for body in replies)} из {len(paths)}")
+    print(f"   webhook p95: {_percentile(webhook, 0.95) * 1000:.1f} мс")
+    return latencies, pages, errors
+
+def _worker(args, corpus, mode, paths, queue):
+    """Отдельный процесс: окружение заглушек, прогрев, замер."""
+    os.environ.update({
+        "OCR_BACKEND": "tesseract",  # движок все равно подменяется заглушкой
+        "RESULT_CACHE_ENABLED": "0",  # каждый прогон — полная обработка, а не кэш
+        "MESSAGING_TRANSPORT": "stub",
+        "MESSAGING_STUB_LATENCY": str(args.twilio_ms / 1000),
+        "TWILIO_RATE_PER_SECOND": "1000",
+        "JOB_WORKERS": "0",  # задачи из очереди выполняет сам бенчмарк
+        "STORAGE_PROVIDER": args.storage,
+        "DATABASE_URL": f"sqlite:///{os.path.abspath(os.path.join(BENCH_DIR, f'bench_{corpus}_{mode}.db'))}",
+        "METRICS_DIR": os.path.join(BENCH_DIR, "metrics"),
+    })
+    db_path = os.environ["DATABASE_URL"][len("sqlite:///"):]
+    if os.path.exists(db_path): os.remove(db_path)
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+
+    engine = _install_fakes(args, corpus)
+    from database import init_db
+    init_db()
+    run = _run_e2e if mode == "e2e" else _run_processor
+
+    run(args, corpus, paths[:1], engine)  # прогрев: импорты, пулы, соединения
+    started = time.perf_counter()
+    latencies, pages, errors = run(args, corpus, paths, engine)
+    wall = time.perf_counter() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put({"corpus": corpus, "mode": mode, "files": len(paths), "pages": pages,
+               "expected_pages": len(paths) * _pages_per_file(corpus), "errors": errors[:10], "wall": wall,
+               "pages_per_sec": pages / wall if wall else 0, "p50": _percentile(latencies, 0.5),
+               "p95": _percentile(latencies, 0.95), "peak_rss_mb": peak_rss})
+
+def run_benchmark(args):
+    """Возвращает (результаты, ok): ok=False, если прогон упал или обработал не все страницы."""
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    results = []
+    ok = True
+    for corpus in args.corpus.split(","):
+        paths = _make_corpus(corpus, args.files)
+        for mode in ("processor", "e2e"):
+            print(f"⏳ {corpus} / {mode}...")
+            p = ctx.Process(target=_worker, args=(args, corpus, mode, paths, queue))
+            p.start()
+            p.join()
+            if p.exitcode != 0:
+                print(f"❌ {corpus} / {mode}: процесс завершился с кодом {p.exitcode}")
+                ok = False
+                continue
+            results.append(queue.get())
+
+    print(f"\n📊 Vision {args.vision_ms} мс, OpenAI {args.openai_ms} мс, облако {args.storage_ms} мс, Twilio {args.twilio_ms} мс")
+    print(f"{'корпус':<9}{'режим':<11}{'файлов':>7}{'страниц':>9}{'стр/с':>8}{'p50, с':>9}{'p95, с':>9}{'пик RSS, МБ':>13}")
+    for r in results:
+        print(f"{r['corpus']:<9}{r['mode']:<11}{r['files']:>7}{r['pages']:>9}{r['pages_per_sec']:>8.2f}"
+              f"{r['p50']:>9.2f}{r['p95']:>9.2f}{r['peak_rss_mb']:>13.1f}")
+    for r in results:
+        if r["errors"] or r["pages"] != r["expected_pages"]:
+            print(f"❌ {r['corpus']}/{r['mode']}: страниц {r['pages']} из {r['expected_pages']}")
+            for error in r["errors"]: print(f"   {error}")
+            ok = False
+    return results, ok
+
+def check_baseline(results, baseline_path, tolerance):
+    """Сравнение с сохраненным прогоном: падение скорости или рост p95 больше tolerance — регрессия."""
+    with open(baseline_path) as f:
+        baseline = {(r["corpus"], r["mode"]): r for r in json.load(f)}
+    failed = False
+    for r in results:
+        base = baseline.get((r["corpus"], r["mode"]))
+        if not base: continue
+        if r["pages_per_sec"] < base["pages_per_sec"] * (1 - tolerance):
+            print(f"❌ {r['corpus']}/{r['mode']}: {r['pages_per_sec']:.2f} стр/с, было {base['pages_per_sec']:.2f}")
+            failed = True
+        if r["p95"] > base["p95"] * (1 + tolerance):
+            print(f"❌ {r['corpus']}/{r['mode']}: p95 {r['p95']:.2f}s, было {base['p95']:.2f}s")
+            failed = True
+    print("✅ Регрессий нет" if not failed else "❌ Есть регрессии")
+    return not failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default="photo,scan,digital")
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--storage", choices=("yandex", "dropbox"), default="yandex")
+    parser.add_argument("--vision-ms", type=float, default=400)
+    parser.add_argument("--openai-ms", type=float, default=900)
+    parser.add_argument("--storage-ms", type=float, default=200)
+    parser.add_argument("--twilio-ms", type=float, default=100)
+    parser.add_argument("--media-ms", type=float, default=150)
+    parser.add_argument("--save")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    results, ok = run_benchmark(args)
+    if args.save and ok:
+        with open(args.save, "w") as f: json.dump(results, f, indent=2)
+    if args.baseline and not check_baseline(results, args.baseline, args.tolerance):
+        ok = False
+    if not ok:
+        sys.exit(1)
@@ -0,0 +1,91 @@
+"""
+Микробенчмарк подготовки страницы: старый путь на PIL против image_pipeline (NumPy/OpenCV).
+Шаги те же, что в пайплайне: ориентация, поворот на 90, кроп, контраст,
+JPEG для OCR и JPEG для PDF.
+
+    python tests/bench_preprocess.py [путь_к_фото] [повторов]
+
+Без аргументов генерирует синтетическое фото 4000x3000 (12 MP).
+Каждый вариант запускается в отдельном процессе, чтобы честно померить пик памяти (ru_maxrss).
+"""
+
+import sys
+import os
+import io
+import time
+import resource
+import multiprocessing
+# Добавляем корневую папку в путь, чтобы видеть services
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+ROTATION = 90
+CROP = (200, 300, 2800, 3700)  # в координатах повернутой страницы
+
+def _make_photo(path):
+    import numpy as np
+    import cv2
+    rng = np.random.default_rng(0)
+    arr = rng.integers(90, 200, size=(3000, 4000, 3), dtype=np.uint8)
+    for y in range(200, 2800, 60):
+        cv2.putText(arr, "PASSPORT  ISRAEL  1234567  IVANOV IVAN", (300, y), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (20, 20, 20), 3)
+    cv2.imwrite(path, arr, [cv2.IMWRITE_JPEG_QUALITY, 92])
+
+def _pil_path(path):
+    from PIL import Image, ImageOps, ImageEnhance
+    img = Image.open(path)
+    img = ImageOps.exif_transpose(img)
+    ocr_jpeg = io.BytesIO()
+    img.save(ocr_jpeg, format="JPEG")
+    img = img.rotate(ROTATION, expand=True)
+    img = img.crop(CROP)
+    img = ImageEnhance.Contrast(img).enhance(1.2)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=90)
+    return len(out.getvalue())
+
+def _numpy_path(path):
+    from services import image_pipeline
+    arr = image_pipeline.load_image(path)
+    image_pipeline.encode_jpeg(arr)  # для OCR
+    arr = image_pipeline.prepare_page(arr, {"rotation": ROTATION, "crop": CROP})
+    return len(image_pipeline.encode_jpeg(arr))
+
+def _run(name, path, repeats, queue):
+    fn = {"pil": _pil_path, "numpy": _numpy_path}[name]
+    fn(path)  # прогрев: импорты и кодеки
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(repeats): fn(path)
+    cpu = (time.process_time() - cpu_start) / repeats
+    wall = (time.perf_counter() - wall_start) / repeats
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((name, cpu, wall, peak_rss))
+
+def run_benchmark(path, repeats):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    results = []
+    for name in ("pil", "numpy"):
+        p = ctx.Process(target=_run, args=(name, path, repeats, queue))
+        p.start()
+        results.append(queue.get())
+        p.join()
+
+    print(f"\n📊 {os.path.basename(path)}, повторов: {repeats}")
+    print(f"{'путь':<8}{'CPU/стр, мс':>14}{'время/стр, мс':>16}{'пик RSS, МБ':>14}")
+    for name, cpu, wall, peak_rss in results:
+        print(f"{name:<8}{cpu * 1000:>14.1f}{wall * 1000:>16.1f}{peak_rss / 1024:>14.1f}")
+
+if __name__ == "__main__":
+    target = sys.argv[1] if len(sys.argv) > 1 else None
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    if target:
+        run_benchmark(target, repeats)
+    else:
+        # Синтетическое фото — во временной папке, в рабочем дереве ничего не остается
+        import tempfile
+        with tempfile.TemporaryDirectory(prefix="bench_preprocess_") as folder:
+            target = os.path.join(folder, "bench_photo.jpg")
+            _make_photo(target)
+            run_benchmark(target, repeats)
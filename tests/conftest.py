@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# База, метрики и кэш тестов — во временной папке (до импорта database и services)
+_tmp = tempfile.mkdtemp(prefix="lawbot_tests_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'test.db')}"
+os.environ["METRICS_DIR"] = os.path.join(_tmp, "metrics")
+os.environ["RESULT_CACHE_ENABLED"] = "0"
+os.environ["MESSAGING_TRANSPORT"] = "stub"
+
+# Добавляем корневую папку в путь, чтобы видеть services
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,65 @@
+"""
+Сборка PDF из страниц (этап загрузки DocumentProcessor) без сети и ключей.
+    python -m pytest tests/test_doc_processor.py
+"""
+import io
+import os
+import sys
+import pytest
+
+# Добавляем корневую папку в путь, чтобы видеть services
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+fitz = pytest.importorskip("fitz")
+doc_processor = pytest.importorskip("services.doc_processor")
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+def _processor(tmp_path):
+    # Без __init__: OCR-движок для сборки PDF не нужен
+    processor = doc_processor.DocumentProcessor.__new__(doc_processor.DocumentProcessor)
+    processor.temp_dir = str(tmp_path)
+    return processor
+
+def _text_page(text):
+    with fitz.open() as doc:
+        doc.new_page().insert_text((72, 72), text)
+        return doc.tobytes()
+
+def _jpeg_page():
+    arr = np.full((400, 300, 3), 200, dtype=np.uint8)
+    return cv2.imencode(".jpg", arr)[1].tobytes()
+
+def _rec(index, pdf_bytes=None, jpeg=None):
+    return {"index": index, "pdf_bytes": pdf_bytes, "jpeg": jpeg}
+
+def test_merge_two_text_pages_into_spooled_buffer(tmp_path):
+    processor = _processor(tmp_path)
+    recs = [_rec(1, pdf_bytes=_text_page("first")), _rec(2, pdf_bytes=_text_page("second"))]
+    with processor._spool() as out:
+        processor._merge_pdfs(recs, out)
+        out.seek(0)
+        with fitz.open("pdf", out.read()) as merged:
+            assert merged.page_count == 2
+            assert "first" in merged[0].get_text() and "second" in merged[1].get_text()
+
+def test_merge_text_and_spilled_jpeg_pages(tmp_path):
+    processor = _processor(tmp_path)
+    buffers = doc_processor.PageBuffers(str(tmp_path), max_bytes=0)  # все JPEG — во временные файлы
+    jpeg = buffers.put(_jpeg_page())
+    assert not isinstance(jpeg, bytes) and buffers.spilled == 1
+
+    recs = [_rec(1, pdf_bytes=_text_page("text")), _rec(2, jpeg=jpeg)]
+    out = io.BytesIO()
+    processor._merge_pdfs(recs, out)
+    with fitz.open("pdf", out.getvalue()) as merged:
+        assert merged.page_count == 2
+    assert recs[1]["jpeg"] is None and jpeg.closed
+
+def test_page_buffers_keep_small_pages_in_memory(tmp_path):
+    buffers = doc_processor.PageBuffers(str(tmp_path), max_bytes=10)
+    assert buffers.put(b"12345") == b"12345"
+    assert buffers.put(b"67890") == b"67890"
+    spilled = buffers.put(b"x")
+    assert doc_processor.PageBuffers.read(spilled) == b"x"
+    doc_processor.PageBuffers.release(spilled)
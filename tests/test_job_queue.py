@@ -0,0 +1,135 @@
+"""
+Очередь задач на SQLite: аренда, перехват задачи умершего воркера, запись только владельцем.
+    python -m pytest tests/test_job_queue.py
+"""
+from datetime import datetime, timedelta
+import pytest
+
+pytest.importorskip("sqlmodel")
+from sqlmodel import Session, delete
+from database import init_db, engine, Job, WorkerHeartbeat
+from services import job_queue, health
+
+@pytest.fixture(autouse=True)
+def clean_queue():
+    init_db()
+    with Session(engine) as session:
+        session.exec(delete(Job))
+        session.exec(delete(WorkerHeartbeat))
+        session.commit()
+    job_queue._next_reclaim = 0.0
+
+def _expire(job_id):
+    with Session(engine) as session:
+        job = session.get(Job, job_id)
+        job.lease_until = datetime.now() - timedelta(seconds=1)
+        session.add(job)
+        session.commit()
+    job_queue._next_reclaim = 0.0  # перехват истекших аренд не ждет своего интервала
+
+def _ready_now(job_id):
+    # Повтор не ждет экспоненциальной задержки
+    with Session(engine) as session:
+        job = session.get(Job, job_id)
+        job.run_after = datetime.now() - timedelta(seconds=1)
+        session.add(job)
+        session.commit()
+
+def _status(job_id):
+    with Session(engine) as session:
+        return session.get(Job, job_id).status
+
+def test_duplicate_message_sid_is_queued_once():
+    first = job_queue.enqueue_job("+1", "url", "image/jpeg", "SM1")
+    assert job_queue.enqueue_job("+1", "url", "image/jpeg", "SM1") == first
+    assert job_queue.queue_depth()["pending"] == 1
+
+def test_job_is_claimed_once():
+    job_queue.enqueue_job("+1", "url", None)
+    assert job_queue.claim_next_job("w1") is not None
+    assert job_queue.claim_next_job("w2") is None
+
+def test_expired_lease_is_reclaimed_and_old_owner_cannot_finish():
+    job_id = job_queue.enqueue_job("+1", "url", None)
+    job_queue.claim_next_job("w1")
+    _expire(job_id)
+
+    job = job_queue.claim_next_job("w2")
+    assert job.id == job_id and job.locked_by == "w2" and job.attempts == 2
+
+    # Первый воркер проснулся: ни закрыть, ни вернуть в очередь чужую задачу не может
+    assert job_queue.complete_job(job_id, "w1") is False
+    assert job_queue.fail_job(job_id, "w1", RuntimeError("late")) is None
+    assert _status(job_id) == "running"
+    assert job_queue.complete_job(job_id, "w2") is True
+    assert _status(job_id) == "done"
+
+def test_handler_stops_before_db_writes_when_lease_lost():
+    job_id = job_queue.enqueue_job("+1", "url", None)
+    job = job_queue.claim_next_job("w1")
+    written, failures = [], []
+
+    def handler(user_phone, media_url, media_type):
+        _expire(job_id)
+        assert job_queue.claim_next_job("w2").id == job_id
+        with Session(engine) as session:
+            job_queue.ensure_lease(session)  # LeaseLostError: результат пишет w2
+            written.append(job_id)
+
+    job_queue.run_job(job, handler, on_failure=failures.append)
+    assert written == [] and failures == []
+    assert _status(job_id) == "running"  # задачу ведет w2
+
+def test_failure_retries_then_fails():
+    job_id = job_queue.enqueue_job("+1", "url", None)
+    failures = []
+
+    def handler(user_phone, media_url, media_type):
+        raise RuntimeError("boom")
+
+    for attempt in range(1, job_queue.JOB_MAX_ATTEMPTS + 1):
+        job = job_queue.claim_next_job("w1")
+        assert job.id == job_id and job.attempts == attempt
+        job_queue.run_job(job, handler, on_failure=failures.append)
+        assert _status(job_id) == ("failed" if attempt == job_queue.JOB_MAX_ATTEMPTS else "pending")
+        _ready_now(job_id)
+
+    assert failures == ["+1"]  # клиенту сообщаем один раз, после последней попытки
+    assert job_queue.claim_next_job("w1") is None
+
+def test_live_workers_from_heartbeats():
+    job_queue._beat("host-a:1")
+    job_queue._beat("host-b:2")
+    with Session(engine) as session:
+        row = session.get(WorkerHeartbeat, "host-b:2")
+        row.seen_at = datetime.now() - timedelta(seconds=job_queue.JOB_LEASE_SECONDS + 1)  # пропал
+        session.add(row)
+        session.commit()
+    assert job_queue.live_workers() == {"live": 1, "stale": 1}
+
+def test_old_heartbeats_are_forgotten_by_workers_only():
+    job_queue._beat("host-a:1")
+    with Session(engine) as session:
+        row = session.get(WorkerHeartbeat, "host-a:1")
+        row.seen_at = datetime.now() - timedelta(seconds=job_queue.WORKER_FORGET_SECONDS + 1)
+        session.add(row)
+        session.commit()
+    assert job_queue.live_workers() == {"live": 0, "stale": 0}
+    with Session(engine) as session:
+        assert session.get(WorkerHeartbeat, "host-a:1") is not None  # проба готовности ничего не пишет
+    job_queue._forget_workers()
+    with Session(engine) as session:
+        assert session.get(WorkerHeartbeat, "host-a:1") is None
+
+def test_readiness_uses_workers_of_all_servers(monkeypatch):
+    # Веб без своих воркеров (EMBEDDED_WORKERS=0): емкость — живые воркеры по отметкам в БД
+    monkeypatch.setitem(health._state, "checked_at", 1.0)
+    monkeypatch.setitem(health._state, "db", {"ok": True, "error": None})
+    monkeypatch.setitem(health._state, "queue", {"pending": 3, "running": 1})
+    monkeypatch.setitem(health._state, "workers", {"live": 2, "stale": 1})
+    report = health.readiness({"configured": 0, "alive": 0})
+    assert report["status"] == "ok"
+    assert report["workers"]["live"] == 2 and report["workers"]["saturation"] == 0.5
+
+    monkeypatch.setitem(health._state, "workers", {"live": 0, "stale": 2})
+    assert health.readiness({"configured": 0, "alive": 0})["reasons"] == ["no_workers"]
@@ -33,22 +33,25 @@ def run_test(file_path):
         # лучше скопировать его во временное имя, если хочешь сохранить оригинал.
         # Но для простоты передадим как есть.
         
-        result = processor.process_and_upload(test_phone, file_path, os.path.basename(file_path))
+        results = processor.process_and_upload(test_phone, file_path, os.path.basename(file_path))
         
         print("\n" + "="*30)
         print("📊 РЕЗУЛЬТАТ:")
         print("="*30)
         
-        if result["status"] == "success":
-            print(f"✅ Статус:      УСПЕХ")
-            print(f"📄 Тип:         {result['doc_type']}")
-            print(f"👤 Имя:         {result['person']}")
-            print(f"📁 Файл:        {result['filename']}")
-            print(f"🔗 Путь (Disk): {result.get('remote_path')}")
+        # process_and_upload возвращает список: по записи на страницу
+        for result in results:
+            if result["status"] == "success":
+                print(f"✅ Стр. {result.get('page', '?')}: УСПЕХ")
+                print(f"📄 Тип:         {result['doc_type']}")
+                print(f"👤 Имя:         {result['person']}")
+                print(f"📁 Файл:        {result['filename']}")
+                print(f"🔗 Путь (Disk): {result.get('remote_path')}")
+            else:
+                print(f"❌ Стр. {result.get('page', '?')}: {result.get('message')}")
             print("-" * 30)
+        if any(r["status"] == "success" for r in results):
             print("Теперь проверь папку '/Clients/TEST_BOT_USER' на Яндекс.Диске")
-        else:
-            print(f"❌ Ошибка: {result.get('message')}")
             
     except Exception as e:
         print(f"❌ Критическая ошибка: {e}")
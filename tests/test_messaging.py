@@ -0,0 +1,38 @@
+"""
+Лимит отправки Twilio, общий для всех процессов (расписание в БД).
+    python -m pytest tests/test_messaging.py
+"""
+import pytest
+
+pytest.importorskip("sqlmodel")
+pytest.importorskip("httpx")
+from sqlmodel import Session, delete
+from database import init_db, engine, SendRate
+from services import messaging
+
+@pytest.fixture(autouse=True)
+def clean_rates():
+    init_db()
+    with Session(engine) as session:
+        session.exec(delete(SendRate))
+        session.commit()
+
+def test_burst_then_rate():
+    delays = [messaging.reserve_send_slot("whatsapp:+1", rate=1, burst=5, now=1000.0) for _ in range(7)]
+    assert delays == [0, 0, 0, 0, 0, 1.0, 2.0]
+
+def test_limit_recovers_after_idle():
+    for _ in range(5): messaging.reserve_send_slot("whatsapp:+1", rate=2, burst=5, now=1000.0)
+    assert messaging.reserve_send_slot("whatsapp:+1", rate=2, burst=5, now=1000.0) == 0.5
+    assert messaging.reserve_send_slot("whatsapp:+1", rate=2, burst=5, now=1010.0) == 0
+
+def test_senders_are_independent():
+    for _ in range(5): messaging.reserve_send_slot("whatsapp:+1", rate=1, burst=5, now=1000.0)
+    assert messaging.reserve_send_slot("whatsapp:+2", rate=1, burst=5, now=1000.0) == 0
+
+def test_concurrent_reservations_share_one_schedule():
+    # Одновременные брони (как из разных процессов) не теряются и не делят слот
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(8) as pool:
+        delays = list(pool.map(lambda _: messaging.reserve_send_slot("whatsapp:+1", rate=1, burst=5, now=1000.0), range(40)))
+    assert sorted(delays) == [0.0] * 5 + [float(n) for n in range(1, 36)]
@@ -0,0 +1,41 @@
+"""
+Отдельный процесс обработки очереди (без веба): python worker.py
+Веб (gunicorn, EMBEDDED_WORKERS=0) только принимает вебхуки и ставит задачи в таблицу job,
+а сколько угодно таких процессов/контейнеров их забирают (см. services/job_queue: аренда, SKIP LOCKED).
+"""
+import time
+import signal
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database import init_db
+from services import health
+from services.job_queue import JOB_WORKERS, start_worker_pool, stop_worker_pool
+from services.messaging import stop_dispatcher
+from main import process_file_task, notify_job_failed, get_processor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("worker")
+
+def main():
+    stop = threading.Event()
+    # docker stop шлет SIGTERM: дорабатываем текущие задачи и выходим
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    started = time.perf_counter()
+    init_db()
+    health.startup_phase("init_db", time.perf_counter() - started)
+    start_worker_pool(process_file_task, on_failure=notify_job_failed, num_workers=max(1, JOB_WORKERS), warmup=get_processor)
+    health.startup_report()
+
+    stop.wait()
+    logger.info("🛑 Stopping job workers...")
+    stop_worker_pool()
+    stop_dispatcher()
+
+if __name__ == "__main__":
+    main()